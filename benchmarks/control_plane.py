@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Benchmark the control plane with several clouds in one process and no real sessions
+
+Runs against fakeredis (with lupa for the claim script) when it is installed,
+otherwise it spawns a redis-server, or use --redis to point at a running server.
+The docker python package must be installed but no docker daemon is needed, the client is made on first use.
+
+> python3 -m benchmarks.control_plane --clouds 4 --requests 200
+"""
+
+import argparse
+import logging
+import socket
+import subprocess
+import sys
+import threading
+import time
+from json import JSONEncoder
+from redis import Redis
+from pycloud.cloud import Cloud
+from pycloud.constants import CREATE_CHANNEL, STATUS_CHANNEL, REMOVE_CHANNEL
+from pycloud.handlers import MessagingEngine, CreateMessaging, NodeMessaging, StatusMessaging, RemoveMessaging, RankMessaging, \
+    RankSyncMessaging
+from pycloud.session import Session
+from pycloud.utils import generate_id
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class NoopSession(Session):
+    """ A session that never touches the disk, tmux or docker """
+
+    def __init__(self, cloud, script, backend=None):
+        super().__init__(cloud, script, backend)
+        self.__cloud = cloud
+
+    def create(self):
+        pass
+
+    def start(self):
+        pass
+
+    def remove(self):
+        self.__cloud.ports().release(self._port)
+
+    def usage(self):
+        return 0.0, 0
+
+
+class RedisServer:
+    """ Hand out redis clients that all talk to the same server """
+
+    def __init__(self, url=None):
+        self.__process = None
+        self.__fake = None
+
+        if url is not None:
+            self.__url = url
+        elif fakeredis is not None:
+            self.__fake = fakeredis.FakeServer()
+        else:
+            with socket.socket() as connection:
+                connection.bind(('127.0.0.1', 0))
+                port = connection.getsockname()[1]
+
+            self.__process = subprocess.Popen(
+                ('redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'),
+                stdout=subprocess.DEVNULL,
+            )
+            self.__url = 'redis://127.0.0.1:{0}/0'.format(port)
+
+    def client(self):
+        """ Get a new client for the server """
+        if self.__fake is not None:
+            return fakeredis.FakeRedis(server=self.__fake)
+
+        client = Redis.from_url(self.__url)
+
+        # Wait for a spawned server to come up
+        for _ in range(50):
+            try:
+                client.ping()
+                break
+            except Exception:
+                time.sleep(0.1)
+
+        return client
+
+    def close(self):
+        if self.__process is not None:
+            self.__process.terminate()
+            self.__process.wait()
+
+
+def percentile(values, percent):
+    """ The nearest rank percentile of the values """
+    if len(values) == 0:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def start_cloud(server):
+    """ Start a cloud with noop sessions and its messaging engine in a daemon thread, returns the engine and thread """
+    cloud = Cloud()
+    cloud.session_type = NoopSession
+    cloud.configure({'hostname': 'localhost'})
+    redis = server.client()
+    engine = MessagingEngine(redis)
+    rank_messaging = RankMessaging(cloud, redis)
+    create_messaging = CreateMessaging(cloud, redis)
+    engine.register(create_messaging)
+    engine.register(NodeMessaging(cloud, redis, create_messaging))
+    engine.register(StatusMessaging(cloud, redis))
+    engine.register(RemoveMessaging(cloud, redis))
+    engine.register(rank_messaging)
+    engine.register(RankSyncMessaging(cloud, redis, rank_messaging))
+    engine.background(rank_messaging.send)
+
+    thread = threading.Thread(target=engine.run, daemon=True)
+    thread.start()
+
+    return engine, thread
+
+
+def drive(server, channel, payloads, timeout):
+    """ Publish every request and wait for the replies, returns the latencies and wall time """
+    client = server.client()
+    replies = client.pubsub(ignore_subscribe_messages=True)
+    replies.psubscribe(channel + '.*')
+    sent = {}
+    latencies = {}
+    started = time.time()
+
+    for hash_id, payload in payloads:
+        sent[hash_id] = time.time()
+        client.publish(channel, JSONEncoder().encode(payload))
+
+    deadline = time.time() + timeout
+
+    while len(latencies) < len(sent) and time.time() < deadline:
+        message = replies.get_message(timeout=0.1)
+
+        if message is None or message['type'] != 'pmessage':
+            continue
+
+        hash_id = message['channel'].decode('utf-8')[len(channel) + 1:]
+
+        if hash_id in sent and hash_id not in latencies:
+            latencies[hash_id] = time.time() - sent[hash_id]
+
+    replies.close()
+
+    return list(latencies.values()), time.time() - started, len(sent) - len(latencies)
+
+
+def report(name, latencies, wall, lost):
+    """ Print the latency percentiles and the throughput """
+    print('{0:<8} p50={1:7.2f}ms p99={2:7.2f}ms rate={3:8.1f}/s lost={4}'.format(
+        name,
+        percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000,
+        len(latencies) / wall if wall > 0 else 0,
+        lost,
+    ))
+
+
+def bench_requests(server, clouds, requests, timeout):
+    """ Benchmark create, status and remove through the clouds """
+    engines = [start_cloud(server) for _ in range(clouds)]
+
+    try:
+        run_requests(server, requests, timeout)
+    finally:
+        for engine, thread in engines:
+            engine.stop()
+            thread.join(5)
+
+
+def run_requests(server, requests, timeout):
+    """ Send the create, status and remove requests and report each of them """
+    # Let every cloud see every rank
+    time.sleep(1.5)
+
+    creates = [(generate_id() + str(i), {'id': None, 'script': 'noop'}) for i in range(requests)]
+
+    for hash_id, payload in creates:
+        payload['id'] = hash_id
+
+    latencies, wall, lost = drive(server, CREATE_CHANNEL, creates, timeout)
+    report('create', latencies, wall, lost)
+
+    sessions = [session.decode('utf-8') for session in server.client().hkeys('year4000.pycloud.sessions')]
+    statuses = [('s' + str(i), {'id': 's' + str(i), 'session': session}) for i, session in enumerate(sessions)]
+    report('status', *drive(server, STATUS_CHANNEL, statuses, timeout))
+
+    removes = [('r' + str(i), {'id': 'r' + str(i), 'session': session}) for i, session in enumerate(sessions)]
+    report('remove', *drive(server, REMOVE_CHANNEL, removes, timeout))
+
+
+def bench_ranks(server, clouds, sessions, messages):
+    """ Measure the cpu time spent decoding and applying ranks as the clouds and sessions grow """
+    redis = server.client()
+    receiver = RankMessaging(Cloud(), redis)
+    senders = []
+
+    for _ in range(clouds):
+        cloud = Cloud()
+        cloud.session_type = NoopSession
+        cloud.configure({
+            'hostname': 'localhost',
+            'capacity': {'max_sessions': sessions},
+            'ports': {'start': 20000, 'end': 20000 + sessions},
+        })
+
+        for _ in range(sessions):
+            cloud.create_session('noop')
+
+        senders.append(RankMessaging(cloud, redis))
+
+    # The first rank of each cloud carries every session, the rest only carry changes
+    for sender in senders:
+        receiver.process(sender.generate().encode('utf-8'))
+
+    payloads = [sender.generate().encode('utf-8') for sender in senders for _ in range(messages)]
+    started = time.process_time()
+
+    for payload in payloads:
+        receiver.process(payload)
+
+    cost = (time.process_time() - started) / len(payloads)
+    size = sum(len(payload) for payload in payloads) / len(payloads)
+
+    # Every cloud sends two ranks a second to every cloud
+    print('ranks    clouds={0:<4} sessions={1:<5} {2:7.1f}us/msg {3:6.0f}B/msg cpu={4:5.2f}% per node'.format(
+        clouds, sessions, cost * 1e6, size, cost * clouds * 2 * 100,
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the PyCloud control plane')
+    parser.add_argument('--redis', help='url of a running redis server instead of fakeredis')
+    parser.add_argument('--clouds', type=int, default=3, help='clouds to run in this process')
+    parser.add_argument('--requests', type=int, default=100, help='create requests to send')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for the replies')
+    parser.add_argument('--rank-clouds', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--rank-sessions', type=int, nargs='+', default=[10, 100, 1000])
+    args = parser.parse_args(argv)
+
+    logging.getLogger('pycloud').setLevel(logging.ERROR)
+    server = RedisServer(args.redis)
+
+    try:
+        bench_requests(server, args.clouds, args.requests, args.timeout)
+
+        for clouds in args.rank_clouds:
+            for sessions in args.rank_sessions:
+                bench_ranks(server, clouds, sessions, 20)
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Token buckets in redis so every cloud admits the creates of a client or group at the same rate """
+
+from .constants import ADMISSION_KEY
+from .utils import check_not_none, default_val, grouped
+
+
+# Refill every bucket by the time since it was last used, take the cost from all of them or from none.
+# A cost larger than the bucket is admitted from a full bucket and leaves it in debt, so the wait grows with the cost.
+# Returns the secs until every bucket has the tokens and the name of the bucket that is the furthest off.
+ADMIT_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local cost = tonumber(ARGV[1])
+local wait = 0
+local reason = ''
+local tokens = {}
+
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local burst = tonumber(ARGV[i * 3])
+    local bucket = redis.call('HMGET', KEYS[i], 'tokens', 'time')
+    local last = tonumber(bucket[2]) or now
+    tokens[i] = math.min(burst, (tonumber(bucket[1]) or burst) + math.max(now - last, 0) * rate)
+
+    -- A cost larger than the bucket needs a full bucket then pays off the rest
+    local need = math.min(cost, burst)
+
+    if tokens[i] < need and (need - tokens[i]) / rate > wait then
+        wait = (need - tokens[i]) / rate
+        reason = ARGV[i * 3 + 1]
+    end
+end
+
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local burst = tonumber(ARGV[i * 3])
+
+    if wait == 0 then
+        tokens[i] = tokens[i] - cost
+    end
+
+    redis.call('HMSET', KEYS[i], 'tokens', tostring(tokens[i]), 'time', tostring(now))
+    redis.call('PEXPIRE', KEYS[i], math.ceil((burst - tokens[i]) / rate * 1000) + 1000)
+end
+
+return {tostring(wait), reason}
+"""
+
+
+class Admission:
+    """ Admit the creates of each client and of the whole group with token buckets shared by every cloud """
+
+    def __init__(self, redis, group=None, client_rate=None, client_burst=None, group_rate=None, group_burst=None):
+        """ Create the buckets, the rates are creates per sec and a bucket without a rate is not checked,
+            a bucket holds at least one create so a rate below one is not doubled """
+        self.__script = check_not_none(redis).register_script(ADMIT_SCRIPT)
+        self.__key = grouped(ADMISSION_KEY, group)
+        self.client_rate = client_rate
+        self.client_burst = default_val(client_burst, max(client_rate or 0, 1))
+        self.group_rate = group_rate
+        self.group_burst = default_val(group_burst, max(group_rate or 0, 1))
+
+    def admit(self, client=None, cost=1):
+        """ Take the cost from the buckets, returns the secs to wait and the empty bucket or 0 and None if admitted """
+        keys = []
+        args = [cost]
+
+        if client is not None and self.client_rate:
+            keys.append(self.__key + '.client.' + str(client))
+            args += [self.client_rate, self.client_burst, 'client']
+
+        if self.group_rate:
+            keys.append(self.__key + '.group')
+            args += [self.group_rate, self.group_burst, 'group']
+
+        if len(keys) == 0:
+            return 0, None
+
+        wait, reason = self.__script(keys=keys, args=args)
+        wait = float(wait)
+
+        return (0, None) if wait == 0 else (wait, reason.decode('utf-8'))
@@ -16,17 +16,22 @@
 
 """ The main entry point to the system """
 
-import threading
 import sys
 import logging
 import os
 import signal
+import socket
 from time import sleep
 from .constants import SESSION_DIR, DATA_DIR, CONFIG_FILE, LOG_FILE, PID_FILE
-from .handlers import CreateMessaging, StatusMessaging, RemoveMessaging, RankMessaging
-from .utils import remove, default_val, required_paths
+from .handlers import MessagingEngine, CreateQueue, CreateMessaging, NodeMessaging, StatusMessaging, RemoveMessaging, \
+    RankMessaging, RankSyncMessaging, LogsMessaging, DrainMessaging, StatsMessaging
+from .utils import remove, default_val, required_paths, Backoff
 from .cloud import Cloud
-from redis import Redis
+from .claims import Claims
+from .admission import Admission
+from .session import Session
+from .metrics import Metrics
+from redis import Redis, BlockingConnectionPool
 from redis.exceptions import ConnectionError
 import yaml
 
@@ -61,22 +66,54 @@ def start_daemon(nodes=None):
 
     main(nodes)
 
+    # The engine stopped after draining on the signal
+    if os.path.exists(PID_FILE):
+        os.remove(PID_FILE)
+
 
 def shutdown_daemon(*args):
     """ Shutdown the method to run when shutting down """
     _log.info('Shutting down PyCloud')
 
-    # Close all running session
-    for session in Cloud.get().sessions():
-        Cloud.get().remove_session(session)
+    # Close the prewarmed and running sessions at once
+    cloud = Cloud.get()
+    drain_config = default_val(cloud.settings.get('drain') if cloud.settings else None, {})
+    cloud.teardown(drain_config.get('grace'))
 
     if len(args) > 0:
         os.remove(PID_FILE)
         raise SystemExit('Terminating on signal number {0}'.format(args[0]))
 
 
+def connection_pool(redis_config, host, port, password, workers):
+    """ The connections to redis shared by every handler, a handler waits for one when they are all in use """
+    options = {
+        'host': host,
+        'port': port,
+        'password': password,
+        'max_connections': default_val(redis_config.get('max_connections'), workers + 8),
+        'timeout': default_val(redis_config.get('timeout'), 5),
+        'socket_connect_timeout': default_val(redis_config.get('timeout'), 5),
+        'health_check_interval': default_val(redis_config.get('health_check_interval'), 30),
+    }
+    keepalive = redis_config.get('keepalive', 60)
+
+    # Find dead connections over links that drop idle ones
+    if keepalive:
+        options['socket_keepalive'] = True
+
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options['socket_keepalive_options'] = {
+                socket.TCP_KEEPIDLE: int(keepalive),
+                socket.TCP_KEEPINTVL: max(int(keepalive) // 4, 1),
+                socket.TCP_KEEPCNT: 4,
+            }
+
+    return BlockingConnectionPool(**options)
+
+
 def main(nodes=None):
-    """ Deploy all the needed threads """
+    """ Deploy the messaging engine """
     nodes = int(0 if nodes is None else nodes)
     cloud = Cloud.get()
     group = cloud.group()
@@ -85,69 +122,130 @@ def main(nodes=None):
 
     _log.info('Importing settings')
     with open(CONFIG_FILE, 'r') as config:
-        cloud.settings = yaml.load(config)
+        cloud.configure(yaml.load(config))
         redis_config = cloud.settings['redis']
         host = default_val(redis_config['host'], 'localhost')
         port = default_val(redis_config['port'], 6379)
         password = redis_config['password'] if 'password' in redis_config else None
+        messaging_config = default_val(cloud.settings.get('messaging'), {})
+        workers = default_val(messaging_config.get('workers'), 8)
+        rank_config = default_val(cloud.settings.get('rank'), {})
+        docker_config = default_val(cloud.settings.get('docker'), {})
+        Session.Docker.configure(docker_config.get('pool_size'), docker_config.get('grace'))
+        output_config = default_val(cloud.settings.get('output'), {})
+        Session.configure(output_config.get('size'), output_config.get('mmap'))
+        native_config = default_val(cloud.settings.get('native'), {})
+        Session.Native.configure(native_config.get('log_size'), native_config.get('log_count'),
+                                 native_config.get('cgroup'), native_config.get('cpu'), native_config.get('memory'))
+        create_config = default_val(cloud.settings.get('create'), {})
+        create_mode = default_val(create_config.get('mode'), 'pubsub')
+        sessions_config = default_val(cloud.settings.get('sessions'), {})
+        capacity = default_val(sessions_config.get('workers'), 4)
+        drain_config = default_val(cloud.settings.get('drain'), {})
+        metrics_config = default_val(cloud.settings.get('metrics'), {})
+        admission_config = default_val(cloud.settings.get('admission'), {})
+        Metrics.configure(metrics_config.get('enabled'))
 
         # Only update region if not pycloud
         if cloud.settings['region'] is not None and group != cloud.settings['region']:
             cloud.group(cloud.settings['region'])
             _log.info("Group: " + group)
 
+    # Take over the sessions of the daemon that ran before so a restart keeps them running
+    _log.info('Adopting sessions from the journal')
+    adopted = cloud.recover()
+
     _log.info('Purging old sessions')
     for folder in os.listdir(DATA_DIR):
-        remove(DATA_DIR + folder)
+        if folder not in adopted:
+            remove(DATA_DIR + folder)
+
+    redis = Redis(connection_pool=connection_pool(redis_config, host, port, password, workers))
+    engine = MessagingEngine(redis, workers, messaging_config.get('publish_window'),
+                             messaging_config.get('publish_size'))
+    redis_rank_messaging = RankMessaging(cloud, redis, rank_config.get('encoding'))
+    admission = None
+
+    # Rate limit the creates of each client and the group across every cloud
+    if admission_config.get('client_rate') or admission_config.get('group_rate'):
+        admission = Admission(redis, cloud.group(), admission_config.get('client_rate'),
+                              admission_config.get('client_burst'), admission_config.get('group_rate'),
+                              admission_config.get('group_burst'))
+
+    redis_create_messaging = CreateMessaging(cloud, redis, admission)
+    engine.register(redis_create_messaging)
+    engine.register(NodeMessaging(cloud, redis, redis_create_messaging))
+    engine.register(StatusMessaging(cloud, redis))
+    engine.register(RemoveMessaging(cloud, redis))
+    engine.register(LogsMessaging(cloud, redis, output_config.get('interval'), output_config.get('chunk')))
+    engine.register(StatsMessaging(cloud, redis))
 
-    redis = Redis(host, port, password=password)
-    redis_create_messaging = CreateMessaging(cloud, redis)
-    redis_status_messaging = StatusMessaging(cloud, redis)
-    redis_remove_messaging = RemoveMessaging(cloud, redis)
-    redis_rank_messaging = RankMessaging(cloud, redis)
+    # Start to accept rank score
+    engine.register(redis_rank_messaging)
+    engine.register(RankSyncMessaging(cloud, redis, redis_rank_messaging))
+    drain_messaging = DrainMessaging(cloud, redis, redis_rank_messaging, drain_config.get('grace'))
+    engine.register(drain_messaging)
 
     # Make sure the connection to redis exists
+    backoff = Backoff()
+
     while True:
         try:
             redis.ping()
             break
         except ConnectionError:
-            _log.error('Trying to connect to redis again')
-            sleep(1)
+            delay = backoff.next()
+            _log.error('Trying to connect to redis again in {0:.1f} secs'.format(delay))
+            sleep(delay)
 
-    # Start the messaging channel to handle sessions
-    daemon_thread(redis_create_messaging.clock, 'Create Channel')
-    daemon_thread(redis_status_messaging.clock, 'Status Channel')
-    daemon_thread(redis_remove_messaging.clock, 'Remove Channel')
+    # Let prometheus scrape the metrics
+    if Metrics.enabled and metrics_config.get('port') is not None:
+        Metrics.get().serve(metrics_config['port'], metrics_config.get('host'))
 
-    # Start to accept rank score
-    daemon_thread(redis_rank_messaging.clock, 'Rank Input')
+    # Reaped sessions are no longer owned by this cloud
+    claims = Claims(cloud, redis)
+    cloud.supervisor().listen(claims.disown)
+
+    # The adopted sessions are owned by the new cloud id so the leader does not answer for them
+    claims.own(*adopted)
 
     # Start the clock to send the rank score
-    daemon_thread(redis_rank_messaging.send, 'Rank Output')
+    engine.background(redis_rank_messaging.send)
+
+    # Sample the host and session resources for the rank
+    capacity_config = default_val(cloud.settings.get('capacity'), {})
+    engine.every(default_val(capacity_config.get('interval'), 2), cloud.monitor().sample)
+
+    # Keep the requested docker images pulled and under the disk budget once this cloud runs docker sessions
+    engine.every(default_val(docker_config.get('interval'), 60), cloud.maintain_images)
+
+    # Pull create requests from the queue as well
+    if create_mode == 'queue':
+        create_queue = CreateQueue(cloud, redis, redis_create_messaging, capacity)
+        _log.info('Consuming create requests from ' + create_queue.queue)
+        engine.background(create_queue.beat)
+        engine.background(create_queue.consume)
+        engine.background(create_queue.recover)
+
+    # Prewarm the sessions for the pool templates
+    cloud.pool().submit_replenish()
 
     # Spin up test nodes for testing
     if nodes > 0:
         for i in range(0, nodes):
-            cloud.create_session('#!/bin/bash\n sleep 240')
+            claims.own(cloud.create_session('#!/bin/bash\n sleep 240').id)
 
         _log.info('Test Sessions: ' + str(cloud.sessions()))
 
-    # Keep app running
-    while True:
-        sleep(1)
-
-
-def daemon_thread(target, name=None):
-    """ Create a daemon thread with specific target """
-    thread = threading.Thread(target=target)
-    thread.setDaemon(True)
+    # Drain the sessions with progress on redis before the engine stops
+    for signum in (signal.SIGABRT, signal.SIGINT):
+        engine.loop.add_signal_handler(signum, drain_messaging.shutdown)
 
-    if name is not None:
-        thread.setName('PyCloud ' + name.title() + ' Thread')
+    # Stop without removing the sessions so the next daemon adopts them
+    engine.loop.add_signal_handler(signal.SIGHUP, engine.loop.stop)
 
-    thread.start()
-    return thread
+    # Run every channel on the event loop
+    engine.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Collect the results of a batch request from every cloud into one reply """
+
+from json import JSONEncoder, JSONDecoder
+from .constants import BATCH_TTL
+from .utils import check_not_none
+
+
+# Add the results once per key, the cloud that completes the batch gets every result back
+COLLECT_SCRIPT = """
+for i = 3, #ARGV, 2 do
+    redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+
+if redis.call('HLEN', KEYS[1]) >= tonumber(ARGV[1]) and redis.call('SET', KEYS[2], 1, 'NX', 'EX', ARGV[2]) then
+    local results = redis.call('HVALS', KEYS[1])
+    redis.call('DEL', KEYS[1])
+    return results
+end
+
+return false
+"""
+
+
+class Batches:
+    """ Collect the results of the batch requests in redis """
+
+    def __init__(self, redis):
+        """ Create the instances with redis """
+        self.__script = check_not_none(redis).register_script(COLLECT_SCRIPT)
+
+    def collect(self, channel, hash_id, expected, results):
+        """ Add the results by key, returns every result once the batch has all that were expected """
+        key = channel + '.' + hash_id + '.batch'
+        args = [expected, BATCH_TTL]
+
+        for result_key, result in results.items():
+            args += [result_key, JSONEncoder().encode(result)]
+
+        collected = self.__script(keys=(key, key + '.done'), args=args)
+
+        if not collected:
+            return None
+
+        return [JSONDecoder().decode(result.decode('utf-8')) for result in collected]
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Atomic claims in redis so exactly one cloud answers a request """
+
+from .constants import SESSIONS_KEY, CLAIM_TTL
+from .utils import check_not_none, grouped
+
+
+# Claim the request unless the session belongs to another cloud that is still alive
+CLAIM_SCRIPT = """
+if ARGV[3] ~= '' then
+    local owner = redis.call('HGET', KEYS[2], ARGV[3])
+
+    if owner and owner ~= ARGV[1] then
+        for i = 4, #ARGV do
+            if ARGV[i] == owner then
+                return 0
+            end
+        end
+    end
+end
+
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+
+return 0
+"""
+
+
+class Claims:
+    """ Claim requests and track which cloud owns each session """
+
+    def __init__(self, cloud, redis):
+        """ Create the instances with redis and cloud """
+        self.__cloud = check_not_none(cloud)
+        self.__redis = check_not_none(redis)
+        self.__script = redis.register_script(CLAIM_SCRIPT)
+        self.__sessions = grouped(SESSIONS_KEY, cloud.group())
+
+    def claim(self, channel, hash_id, session=None):
+        """ Try to claim the request, only one cloud will ever win the claim """
+        live_clouds = self.__cloud.cloud_ids()
+        keys = (channel + '.' + hash_id + '.claim', self.__sessions)
+        args = [self.__cloud.id, int(CLAIM_TTL * 1000), '' if session is None else session] + live_clouds
+
+        return self.__script(keys=keys, args=args) == 1
+
+    def own(self, *sessions):
+        """ Record that this cloud owns the sessions """
+        pipe = self.__redis.pipeline()
+
+        for session in sessions:
+            pipe.hset(self.__sessions, session, self.__cloud.id)
+
+        pipe.execute()
+
+    def owner(self, session):
+        """ Get the id of the cloud that owns the session or None """
+        owner = self.__redis.hget(self.__sessions, session)
+        return None if owner is None else owner.decode('utf-8')
+
+    def disown(self, *sessions):
+        """ Remove the record that this cloud owns the sessions """
+        if len(sessions) > 0:
+            self.__redis.hdel(self.__sessions, *sessions)
@@ -17,31 +17,75 @@
 """ The daemon process that manages the servers """
 
 import os
+import logging
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
+from collections import OrderedDict
 from json import JSONEncoder
-from time import time
+from time import time, sleep
 from .session import Session
-from .utils import generate_id, check_not_none
-import psutil
+from .placement import Placement
+from .resources import ResourceMonitor
+from .pool import WarmPool
+from .images import ImageManager
+from .supervisor import Supervisor
+from .ports import PortAllocator
+from .journal import Journal
+from .metrics import Metrics, TimedLock
+from .tracing import Tracer
+from .constants import DATA_DIR, JOURNAL_FILE, DEFAULT_GROUP
+from .utils import generate_id, check_not_none, default_val, sessions_hash
+
+
+_log = logging.getLogger('pycloud')
+_metrics = Metrics.get()
+_lock_wait = _metrics.histogram('pycloud_lock_wait_seconds', 'Time spent waiting for a lock', ('lock',),
+                                (0.000001, 0.00001, 0.0001, 0.001, 0.01, 0.1, 1))
+_create_seconds = _metrics.histogram('pycloud_create_seconds', 'Time to create a session', ('backend',))
+_create_stage_seconds = _metrics.histogram('pycloud_create_stage_seconds', 'Time of each create stage', ('stage',))
+_create_errors = _metrics.counter('pycloud_create_errors_total', 'Sessions that failed to create', ('backend',))
+_metrics.gauge('pycloud_sessions', 'Sessions running by backend', ('backend',),
+               lambda: Cloud.get().session_backends())
+_metrics.gauge('pycloud_ports_free', 'Ports free for new sessions', func=lambda: len(Cloud.get().ports()))
+_metrics.gauge('pycloud_warm_sessions', 'Prewarmed sessions in the pool', func=lambda: len(Cloud.get().pool()))
+_metrics.gauge('pycloud_clouds', 'Clouds with a rank that is not outdated', func=lambda: len(Cloud.get().get_ranks()))
 
 
 class Cloud:
     """ The cloud instance that stores the sessions that are running """
 
     __inst = None
+    session_type = Session
 
     def __init__(self):
         Cloud.__inst = self
-        self.__sessions_lock = Lock()
-        self.__ranks_lock = Lock()
+        self.__sessions_lock = TimedLock(_lock_wait, 'sessions')
+        self.__init_lock = Lock()
         self.id = generate_id()
-        self.__sessions = []
+        self.__sessions = OrderedDict()
+        self.__session_state = (0, 0, ())
         self.__session_counter = 0
+        self.__pipeline = None
+        self.__placement = None
+        self.__monitor = None
+        self.__pool = None
+        self.__images = None
+        self.__supervisor = None
+        self.__ports = None
+        self.__journal = None
+        self.__tracer = None
+        self.__draining = False
+        self.__docker = False
         self.settings = None
-        self.__group = os.getenv('PYCLOUD_GROUP', 'pycloud')
-        self.__ranks = set()
+        self.__group = os.getenv('PYCLOUD_GROUP', DEFAULT_GROUP)
+        self.__ranks = RankTable()
         self.__ranks.add(self.generate_rank())
 
+        # Listen before any session starts so no exit is missed, the tmux client connects on its first command
+        Session.Tmux.control().listen(self.__session_exited)
+        Session.Native.processes().listen(self.__session_exited)
+
     @staticmethod
     def get():
         """ Get the cloud instance """
@@ -50,14 +94,53 @@ class Cloud:
 
         return Cloud.__inst
 
+    def configure(self, settings):
+        """ Use the settings and reset everything that was created from the old settings """
+        self.settings = settings
+        self.__placement = None
+        self.__monitor = None
+        self.__pool = None
+        self.__images = None
+        self.__supervisor = None
+        self.__ports = None
+        self.__journal = None
+        self.__tracer = None
+
     def sessions(self):
         """ Get all the session ids that are running """
-        sessions = ()
+        return self.session_state()[2]
 
-        for session in self.__sessions:
-            sessions += (repr(session),)
+    def session_state(self):
+        """ Get the version, hash and ids of the sessions, the version changes with every change """
+        state = self.__session_state
 
-        return sessions
+        # Changes only drop the ids so they stay constant time, the first read after a change builds them
+        if state[2] is None:
+            with self.__sessions_lock:
+                state = self.__session_state
+
+                if state[2] is None:
+                    state = (state[0], state[1], tuple(self.__sessions))
+                    self.__session_state = state
+
+        return state
+
+    def session_backends(self):
+        """ Get the number of sessions running by backend """
+        backends = dict.fromkeys(Session.backends, 0)
+
+        for session in list(self.__sessions.values()):
+            backends[session.backend] = backends.get(session.backend, 0) + 1
+
+        return backends
+
+    def session_count(self):
+        """ Get the number of sessions that are running """
+        return len(self.__sessions)
+
+    def get_session(self, hash_id):
+        """ Get the session by its id or None """
+        return self.__sessions.get(check_not_none(hash_id))
 
     def group(self, group=None):
         """ Get or set the group for the cloud """
@@ -66,68 +149,246 @@ class Cloud:
         else:
             self.__group = group
 
-    def create_session(self, script):
-        """ Create a new session from the json input """
+    def backend(self):
+        """ The backend of the sessions when the request does not pick one, docker when it is forced by the env """
+        if Session.uses_docker():
+            return 'docker'
+
+        sessions_config = default_val(self.settings.get('sessions') if self.settings else None, {})
+        return default_val(sessions_config.get('backend'), 'tmux')
+
+    def runs_docker(self):
+        """ Does this cloud run docker sessions, by default or because a request picked docker """
+        return self.__docker or self.backend() == 'docker'
+
+    def maintain_images(self):
+        """ Keep the docker images pulled and under the budget once this cloud runs docker sessions """
+        if self.runs_docker():
+            self.images().maintain()
+
+    def pipeline(self):
+        """ Get the worker pool that runs the session creation pipeline """
+        with self.__init_lock:
+            if self.__pipeline is None:
+                sessions_config = default_val(self.settings.get('sessions') if self.settings else None, {})
+                workers = default_val(sessions_config.get('workers'), 4)
+                self.__pipeline = ThreadPoolExecutor(max_workers=workers)
+
+            return self.__pipeline
+
+    def submit_session(self, script, backend=None, trace=None):
+        """ Run create_session in the pipeline worker pool, returns the future """
+        return self.pipeline().submit(self.create_session, script, backend, trace)
+
+    def create_session(self, script, backend=None, trace=None):
+        """ Create a new session from the json input, only the register stage holds the lock """
+        if self.__draining:
+            raise Exception('Cloud is draining')
+
+        timings = OrderedDict()
+        clock = time()
+
+        # The time the request waited for a pipeline worker
+        if trace is not None:
+            clock = trace.stage('pipeline')
+
+        start = clock
+
+        # PYCLOUD_USE_DOCKER forces docker whatever backend the request picked
+        if Session.uses_docker():
+            backend = None
+
+        # Use a prewarmed session when there is one for the script, they all use the default backend
+        session = self.pool().take(script) if backend in (None, self.backend()) else None
+
+        if session is not None:
+            clock = Cloud.__stage(timings, 'warm', clock)
+        else:
+            # Reserve the id and port
+            session = self.session_type(self, script, backend)
+            clock = Cloud.__stage(timings, 'reserve', clock)
+
+        session.trace = trace
+
+        if session.backend == 'docker':
+            self.__docker = True
+
+        try:
+            # Prepare the directory and script
+            if 'warm' not in timings:
+                session.create()
+                clock = Cloud.__stage(timings, 'prepare', clock)
+
+            # Launch the process, tmux session or docker container
+            session.start()
+            clock = Cloud.__stage(timings, 'launch', clock)
+        except:
+            _create_errors.inc(session.backend)
+
+            if trace is not None:
+                trace.stages(timings, start)
+
+            session.remove()
+            raise
+
         with self.__sessions_lock:
-            session = Session(self, script)
-            self.__sessions.append(session)
+            if trace is not None:
+                trace.span('lock', clock, parent='register')
+
+            self.__sessions[session.id] = session
+            version, ids_hash, _ = self.__session_state
+            self.__session_state = (version + 1, sessions_hash((session.id,), ids_hash), None)
             self.__session_counter += 1
 
-            session.create()
-            session.start()
+        self.journal().add(session)
+        clock = Cloud.__stage(timings, 'register', clock)
+
+        # Watch for the session to exit
+        try:
+            self.supervisor().watch(session)
+        except Exception as error:
+            _log.error('Could not watch session {0}: {1}'.format(repr(session), error))
+
+        Cloud.__stage(timings, 'watch', clock)
+        session.timings = timings
+        session.trace = None
+
+        if trace is not None:
+            trace.stages(timings, start)
+
+        if Metrics.enabled:
+            _create_seconds.observe(sum(timings.values()), session.backend)
+
+            for stage, duration in timings.items():
+                _create_stage_seconds.observe(duration, stage)
+
+        _log.info('Created session {0} in {1}'.format(repr(session), ', '.join(
+            '{0}={1:.3f}s'.format(stage, duration) for stage, duration in timings.items()
+        )))
 
         return session
 
+    @staticmethod
+    def __stage(timings, stage, clock):
+        """ Record the time the stage took and return the new clock """
+        now = time()
+        timings[stage] = now - clock
+        return now
+
     def is_session(self, hash_id):
         """ Does a session exists sessions """
-        session = None
-        check_not_none(hash_id)
-
-        for node in self.__sessions:
-            if node.id == hash_id:
-                session = node
+        return check_not_none(hash_id) in self.__sessions
 
-        return session is not None
+    def is_alive(self, hash_id):
+        """ Does the session exist and is its process running """
+        session = self.__sessions.get(check_not_none(hash_id))
+        return session is not None and session.alive
 
     def remove_session(self, hash_id):
         """ Remove a session from sessions """
-        session = None
         check_not_none(hash_id)
 
-        for node in self.__sessions:
-            if node.id == hash_id:
-                session = node
+        with self.__sessions_lock:
+            session = self.__sessions.pop(hash_id, None)
 
-        if session is None:
-            raise Exception('Session not found')
+            if session is None:
+                raise Exception('Session not found')
 
-        with self.__sessions_lock:
-            self.__sessions.remove(session)
-            session.remove()
+            version, ids_hash, _ = self.__session_state
+            self.__session_state = (version + 1, sessions_hash((session.id,), ids_hash), None)
+
+        # Tearing down the session does not need the lock
+        self.journal().remove((session.id,))
+        session.remove()
 
         return session
 
-    def remove_ranks(self):
-        """ Get the ranks and sort them """
-        current_time = time() - 1
-        copy_ranks = self.__ranks.copy()
+    def remove_sessions(self, hash_ids):
+        """ Remove the sessions at once, returns the removed sessions and the future of the teardown """
+        with self.__sessions_lock:
+            sessions = [self.__sessions.pop(hash_id) for hash_id in hash_ids if hash_id in self.__sessions]
+            version, ids_hash, _ = self.__session_state
+            ids = tuple(session.id for session in sessions)
+            self.__session_state = (version + 1, sessions_hash(ids, ids_hash), None)
 
-        with self.__ranks_lock:
-            for rank in copy_ranks:
-                if rank.time < current_time:
-                    self.__ranks.remove(rank)
+        self.journal().remove(ids)
+        return sessions, Session.remove_all(sessions)
 
-    def get_ranks(self):
+    def drain(self):
+        """ Stop taking new work, the rank reports the cloud as full """
+        self.__draining = True
+
+    def is_draining(self):
+        """ Is this cloud draining its sessions to shut down """
+        return self.__draining
+
+    def teardown(self, grace=None, progress=None):
+        """ Remove every session at once, the ones still running at the deadline are killed """
+        grace = default_val(grace, 30)
+        deadline = time() + grace
+        self.drain()
+        self.pool().drain()
+
+        with self.__sessions_lock:
+            sessions = list(self.__sessions.values())
+            self.__sessions.clear()
+            version, ids_hash, _ = self.__session_state
+            ids = tuple(session.id for session in sessions)
+            self.__session_state = (version + 1, sessions_hash(ids, ids_hash), ())
+
+        self.journal().remove(ids)
+        total = len(sessions)
+        processes = [session for session in sessions if session.backend != 'docker']
+        containers = Session.remove_all([session for session in sessions if session.backend == 'docker'], grace)
+
+        # Every process group gets SIGTERM at once and they share the deadline
+        for session in processes:
+            session.terminate()
+
+        running = processes
+        removed = 0
+
+        while len(running) > 0 and time() < deadline:
+            running = [session for session in running if session.is_running()]
+
+            # The docker sessions are reported once their teardown is done
+            if progress is not None and removed != len(processes) - len(running):
+                removed = len(processes) - len(running)
+                progress(removed, total)
+
+            if len(running) > 0:
+                sleep(min(0.1, max(deadline - time(), 0)))
+
+        if len(running) > 0:
+            _log.warning('{0} sessions did not exit in {1}s, killing them'.format(len(running), grace))
+
+        # Removing kills what is left and cleans up the directories, ports and output
+        for _ in self.pipeline().map(Session.remove, processes):
+            pass
+
+        if containers is not None:
+            containers.result()
+
+        if progress is not None:
+            progress(total, total)
+
+        return sessions
+
+    def remove_ranks(self):
         """ Remove outdated ranks """
-        ranks = []
+        self.__ranks.expire()
 
-        for rank in self.__ranks:
-            if rank not in ranks:
-                ranks.append(rank)
+    def get_ranks(self):
+        """ Get the ranks sorted by score """
+        return self.__ranks.ranks()
 
-        ranks.sort()
+    def available_ranks(self):
+        """ Get the ranks that are not full sorted by score """
+        return self.__ranks.available()
 
-        return ranks
+    def cloud_ids(self):
+        """ Get the ids of the clouds that are alive """
+        return self.__ranks.ids()
 
     def add_rank(self, rank):
         """ Add the rank to the ranks list """
@@ -135,38 +396,323 @@ class Cloud:
         if not isinstance(rank, Rank):
             raise TypeError('Rank must be a Rank type')
 
-        with self.__ranks_lock:
-            if rank not in self.__ranks:
-                self.__ranks.add(rank)
-            else:
-                self.__ranks.remove(rank)
-                self.__ranks.add(rank)
+        self.__ranks.add(rank)
+
+    def placement(self):
+        """ Get the placement strategy that is selected in the settings """
+        if self.__placement is None:
+            self.__placement = Placement.get(self.settings.get('placement') if self.settings else None)
+
+        return self.__placement
+
+    def monitor(self):
+        """ Get the resource monitor with the capacity limits in the settings """
+        if self.__monitor is None:
+            capacity_config = default_val(self.settings.get('capacity') if self.settings else None, {})
+            self.__monitor = ResourceMonitor(
+                self,
+                capacity_config.get('max_sessions'),
+                capacity_config.get('reserved'),
+                capacity_config.get('alpha'),
+            )
+
+        return self.__monitor
+
+    def pool(self):
+        """ Get the pool of prewarmed sessions for the templates in the settings """
+        if self.__pool is None:
+            pool_config = default_val(self.settings.get('pool') if self.settings else None, {})
+            self.__pool = WarmPool(self, pool_config.get('templates'))
+
+        return self.__pool
+
+    def ports(self):
+        """ Get the allocator of the port range in the settings """
+        with self.__init_lock:
+            if self.__ports is None:
+                ports_config = default_val(self.settings.get('ports') if self.settings else None, {})
+                self.__ports = PortAllocator(ports_config.get('start'), ports_config.get('end'))
+
+            return self.__ports
+
+    def tracer(self):
+        """ Get the tracer with the sampling and export in the settings """
+        if self.__tracer is None:
+            tracing_config = default_val(self.settings.get('tracing') if self.settings else None, {})
+            self.__tracer = Tracer(
+                tracing_config.get('sample'),
+                tracing_config.get('slow'),
+                tracing_config.get('export'),
+            )
+
+        return self.__tracer
+
+    def journal(self):
+        """ Get the journal of the sessions when it is enabled in the settings """
+        with self.__init_lock:
+            if self.__journal is None:
+                journal_config = default_val(self.settings.get('journal') if self.settings else None, {})
+                path = JOURNAL_FILE if journal_config.get('enabled') else None
+                self.__journal = Journal(path, journal_config.get('fsync'))
+
+            return self.__journal
+
+    def recover(self):
+        """ Take over the sessions in the journal that are still running and reap the rest, returns their ids """
+        adopted = []
+        dead = []
+        records = self.journal().replay().values()
+
+        for record in records:
+            try:
+                # The script is written with a new line at the end
+                with open(DATA_DIR + record['id'] + '/pycloud.init', 'r') as file:
+                    script = file.read()[:-1]
+
+                if Journal.script_hash(script) != record['script']:
+                    raise ValueError('the script does not match the journal')
+
+                session = self.session_type(self, script, record['backend'], record['id'], record['port'])
+            except (OSError, ValueError, KeyError) as error:
+                _log.error('Could not adopt session {0}: {1}'.format(record.get('id'), error))
+                continue
+
+            try:
+                running = session.adopt(record.get('pid'))
+            except Exception as error:
+                _log.error('Could not adopt session {0}: {1}'.format(session.id, error))
+                running = False
+
+            (adopted if running else dead).append(session)
+
+        if any(session.backend == 'docker' for session in adopted):
+            self.__docker = True
+
+        with self.__sessions_lock:
+            for session in adopted:
+                self.__sessions[session.id] = session
+
+            version, ids_hash, _ = self.__session_state
+            ids = tuple(session.id for session in adopted)
+            self.__session_state = (version + 1, sessions_hash(ids, ids_hash), None)
+
+        self.journal().reset(adopted)
+
+        for session in adopted:
+            self.supervisor().watch(session)
+
+        # The sessions that died while the daemon was down and the ones that were not in the journal
+        teardown = Session.remove_all(dead)
+        self.__remove_orphans(set(ids), any(record.get('backend') == 'docker' for record in records))
+
+        if teardown is not None:
+            teardown.result()
+
+        _log.info('Adopted {0} sessions and reaped {1}'.format(len(adopted), len(dead)))
+        return ids
+
+    def __remove_orphans(self, adopted, containers=False):
+        """ Remove the tmux sessions and containers of the old daemon that were not adopted, like prewarmed ones """
+        folders = set(os.listdir(DATA_DIR))
+
+        if not Session.uses_docker():
+            try:
+                for name in Session.Tmux.sessions():
+                    if name in folders and name not in adopted:
+                        Session.Tmux(name).remove()
+            except Exception as error:
+                _log.error('Could not remove the orphaned tmux sessions: ' + str(error))
+
+        if Session.uses_docker() or containers:
+            try:
+                orphans = [name for name in Session.Docker.containers()
+                           if name[len('pycloud_'):] in folders and name[len('pycloud_'):] not in adopted]
+
+                if len(orphans) > 0:
+                    Session.Docker.remove_all(orphans).result()
+            except Exception as error:
+                _log.error('Could not remove the orphaned docker containers: ' + str(error))
+
+    def __session_exited(self, hash_id):
+        """ Pass the exit to the supervisor of the current settings """
+        self.supervisor().exited(hash_id)
+
+    def supervisor(self):
+        """ Get the supervisor that watches the sessions with the restart policy in the settings """
+        if self.__supervisor is None:
+            supervisor_config = default_val(self.settings.get('supervisor') if self.settings else None, {})
+            self.__supervisor = Supervisor(
+                self,
+                supervisor_config.get('restart'),
+                supervisor_config.get('backoff'),
+                supervisor_config.get('max_backoff'),
+            )
+
+        return self.__supervisor
+
+    def images(self):
+        """ Get the docker image manager with the budget in the settings """
+        if self.__images is None:
+            docker_config = default_val(self.settings.get('docker') if self.settings else None, {})
+            self.__images = ImageManager(Session.Docker.client, docker_config.get('budget'), docker_config.get('prepull'))
+
+        return self.__images
 
-    def is_server(self):
-        """ Check if this session is this session """
-        ranks = self.get_ranks()
+    def is_full(self):
+        """ Is this cloud saturated or draining and should not get more work """
+        return self.__draining or self.monitor().is_full()
 
-        return len(ranks) > 0 and ranks[0].id == self.id
+    def is_server(self, key=None, image=None):
+        """ Check if this cloud owns the request with the key, prefer the clouds that have the image """
+        table = self.__ranks
+
+        if image is not None:
+            image = ImageManager.name(image)
+            ranks = [rank for rank in table.available() if image in rank.images]
+
+            if len(ranks) > 0:
+                table = RankList(ranks)
+
+        owner = self.placement().owner(table, key)
+
+        return owner is not None and owner.id == self.id
 
     def generate_rank(self):
         """ Generate a rank object to send through redis """
         return Rank(cloud=self)
 
 
+class RankTable:
+    """ The ranks of the clouds by id with a heap ordered by score and lazy expiry """
+
+    def __init__(self, ttl=1):
+        """ Create the table, ranks older than the ttl seconds are expired """
+        self.__lock = TimedLock(_lock_wait, 'ranks')
+        self.__ttl = ttl
+        self.__ranks = {}
+        self.__heap = []
+        self.__counter = 0
+        self.__sorted = None
+
+    def __len__(self):
+        return len(self.__ranks)
+
+    def add(self, rank):
+        """ Add or replace the rank of the cloud """
+        with self.__lock:
+            self.__ranks[rank.id] = rank
+            self.__counter += 1
+            heapq.heappush(self.__heap, (rank.full, rank.score, rank.id, self.__counter, rank))
+            self.__sorted = None
+
+            # Replaced ranks stay in the heap until they reach the top, rebuild when there are too many
+            if len(self.__heap) > 2 * len(self.__ranks) + 16:
+                self.__heap = [entry for entry in self.__heap if self.__ranks.get(entry[2]) is entry[4]]
+                heapq.heapify(self.__heap)
+
+    def expire(self):
+        """ Remove all the outdated ranks """
+        expired = time() - self.__ttl
+
+        with self.__lock:
+            for cloud_id in [rank.id for rank in self.__ranks.values() if rank.time < expired]:
+                del self.__ranks[cloud_id]
+                self.__sorted = None
+
+    def leader(self):
+        """ Get the rank with the lowest score that is not full """
+        expired = time() - self.__ttl
+
+        with self.__lock:
+            while len(self.__heap) > 0:
+                rank = self.__heap[0][4]
+
+                if self.__ranks.get(rank.id) is not rank:
+                    heapq.heappop(self.__heap)
+                elif rank.time < expired:
+                    heapq.heappop(self.__heap)
+                    del self.__ranks[rank.id]
+                    self.__sorted = None
+                else:
+                    return None if rank.full else rank
+
+        return None
+
+    def ranks(self):
+        """ Get the ranks that are not outdated sorted by score """
+        return list(self.__snapshot()[1])
+
+    def available(self):
+        """ Get the ranks that are not outdated or full sorted by score """
+        return self.__snapshot()[2]
+
+    def __snapshot(self):
+        """ The sorted ranks are good until a rank is added or the oldest one expires """
+        now = time()
+        cached = self.__sorted
+
+        if cached is None or cached[0] < now:
+            with self.__lock:
+                ranks = sorted((rank for rank in self.__ranks.values() if rank.time >= now - self.__ttl),
+                               key=lambda rank: (rank.score, rank.id))
+                until = min((rank.time for rank in ranks), default=now) + self.__ttl
+                cached = (until, ranks, [rank for rank in ranks if not rank.full])
+                self.__sorted = cached
+
+        return cached
+
+    def ids(self):
+        """ Get the ids of the clouds that are not outdated """
+        return [rank.id for rank in self.ranks()]
+
+
+class RankList:
+    """ A sorted list of ranks that can be used in place of the rank table """
+
+    def __init__(self, ranks):
+        self.__ranks = ranks
+
+    def __len__(self):
+        return len(self.__ranks)
+
+    def leader(self):
+        return self.__ranks[0] if len(self.__ranks) > 0 else None
+
+    def ranks(self):
+        return list(self.__ranks)
+
+    def available(self):
+        return self.__ranks
+
+
 class Rank:
     """ The object that represents the rank of each cloud """
 
-    def __init__(self, cloud_id=None, score=None, unix_time=None, sessions=None, cloud=None):
+    def __init__(self, cloud_id=None, score=None, unix_time=None, sessions=None, cloud=None, full=False, free=None,
+                 version=None, sessions_hash=None, images=None, ports=None, draining=False):
         if cloud is not None:
+            monitor = cloud.monitor()
             self.id = cloud.id
             self.time = time()
-            self.sessions = cloud.sessions()
-            self.score = len(self.sessions) + (psutil.cpu_percent() + psutil.virtual_memory()[2]) / 2
+            self.version, self.sessions_hash, self.sessions = cloud.session_state()
+            self.free = monitor.free()
+            self.draining = cloud.is_draining()
+            self.full = self.free <= 0 or self.draining
+            self.score = len(self.sessions) - cloud.supervisor().restarting() + monitor.host_load()
+            self.images = cloud.images().cached() if cloud.runs_docker() else frozenset()
+            self.ports = len(cloud.ports())
         else:
             self.id = check_not_none(cloud_id, 'Must include cloud id')
             self.score = int(check_not_none(score, 'Must include cloud score'))
             self.time = check_not_none(unix_time, 'Must include unix time of updated')
             self.sessions = check_not_none(sessions, 'Must include the sessions the cloud is running')
+            self.draining = bool(draining)
+            self.full = bool(full) or self.draining
+            self.free = free
+            self.version = version
+            self.sessions_hash = sessions_hash
+            self.images = frozenset(default_val(images, ()))
+            self.ports = ports
 
     def __lt__(self, other):
         return self.score < other.score
@@ -194,7 +740,12 @@ class Rank:
             'id': self.id,
             'score': self.score,
             'time': self.time,
-            'sessions': self.sessions,
+            'sessions': list(self.sessions),
+            'full': self.full,
+            'draining': self.draining,
+            'free': self.free,
+            'images': sorted(self.images),
+            'ports': self.ports,
         })
 
     def __repr__(self):
@@ -24,6 +24,7 @@ DATA_DIR = '/var/lib/year4000/pycloud/'
 LOG_DIR = '/var/log/year4000/pycloud/'
 CONFIG_DIR = '/etc/year4000/pycloud/'
 PID_FILE = SESSION_DIR + 'pycloud.pid'
+JOURNAL_FILE = SESSION_DIR + 'sessions.journal'
 CONFIG_FILE = CONFIG_DIR + 'settings.yml'
 LOG_FILE = LOG_DIR + str(datetime.date.today()) + ".log"
 
@@ -31,3 +32,16 @@ CREATE_CHANNEL = 'year4000.pycloud.create'
 STATUS_CHANNEL = 'year4000.pycloud.status'
 REMOVE_CHANNEL = 'year4000.pycloud.remove'
 RANK_CHANNEL = 'year4000.pycloud.rank'
+RANK_SYNC_CHANNEL = RANK_CHANNEL + '.sync'
+NODE_CHANNEL = 'year4000.pycloud.node'
+LOGS_CHANNEL = 'year4000.pycloud.logs'
+DRAIN_CHANNEL = 'year4000.pycloud.drain'
+STATS_CHANNEL = 'year4000.pycloud.stats'
+CREATE_QUEUE = CREATE_CHANNEL + '.queue'
+CREATE_QUEUE_TTL = 5
+
+SESSIONS_KEY = 'year4000.pycloud.sessions'
+ADMISSION_KEY = 'year4000.pycloud.admission'
+DEFAULT_GROUP = 'pycloud'
+CLAIM_TTL = 60
+BATCH_TTL = 300
@@ -16,54 +16,179 @@
 
 """ The redis handler that will handle the PubSub channel """
 
-from time import sleep
-from json import JSONDecoder
-import threading
+import asyncio
 import logging
-from .constants import CREATE_CHANNEL, STATUS_CHANNEL, REMOVE_CHANNEL, RANK_CHANNEL
+from concurrent.futures import ThreadPoolExecutor
+from json import JSONDecoder, JSONEncoder
+from time import time
+from .constants import NODE_CHANNEL, CREATE_QUEUE, CREATE_QUEUE_TTL, CREATE_CHANNEL, STATUS_CHANNEL, REMOVE_CHANNEL, RANK_CHANNEL, \
+    RANK_SYNC_CHANNEL, LOGS_CHANNEL, DRAIN_CHANNEL, STATS_CHANNEL
 from .cloud import Rank
-from .utils import check_not_none
+from .session import Session
+from .claims import Claims
+from .batch import Batches
+from .placement import Placement
+from .publisher import Publisher
+from .metrics import Metrics
+from .utils import check_not_none, default_val, sessions_hash, grouped, Backoff
 from redis.exceptions import RedisError
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 _log = logging.getLogger('pycloud')
+_metrics = Metrics.get()
+_dispatch_seconds = _metrics.histogram('pycloud_dispatch_seconds', 'Time to handle a message by channel', ('channel',))
+_dispatch_errors = _metrics.counter('pycloud_dispatch_errors_total', 'Messages that failed by channel', ('channel',))
+_task_seconds = _metrics.histogram('pycloud_task_seconds', 'Time of each run of a clock task', ('task',))
+_redis_errors = _metrics.counter('pycloud_redis_errors_total', 'Redis errors that were retried', ('source',))
+_ranks_sent = _metrics.counter('pycloud_rank_sent_total', 'Ranks sent to the other clouds')
+_rank_bytes = _metrics.counter('pycloud_rank_sent_bytes_total', 'Bytes of the ranks sent to the other clouds')
+_ranks_received = _metrics.counter('pycloud_rank_received_total', 'Ranks received from every cloud')
+_rank_publish_seconds = _metrics.histogram('pycloud_rank_publish_seconds', 'Time to publish the rank')
+_rejected = _metrics.counter('pycloud_admission_rejected_total', 'Creates rejected with backpressure', ('reason',))
+
+# Put the request back on the queue unless another cloud already did
+RECOVER_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 1 then
+    redis.call('LPUSH', KEYS[2], ARGV[1])
+    return 1
+end
+
+return 0
+"""
+
+
+class MessagingEngine:
+    """ Multiplex all the messaging channels over one pubsub connection on a single event loop """
+
+    def __init__(self, redis, workers=None, publish_window=None, publish_size=None):
+        """ Create the engine with redis, the size of the blocking executor and how publishes are batched """
+        self._redis = redis
+        self.publisher = Publisher(redis, publish_window, publish_size)
+        self.loop = asyncio.new_event_loop()
+        self.__executor = ThreadPoolExecutor(max_workers=default_val(workers, 8))
+        self.__reader = ThreadPoolExecutor(max_workers=1)
+        self.__handlers = {}
+        self.__tasks = []
+        self.__error = None
 
+    def register(self, messaging):
+        """ Register the messaging handler for the channel it listens on """
+        messaging.engine = self
+        self.__handlers[messaging.channel] = messaging
 
-class Messaging:
-    """ Base class for listening on the redis channel """
+    def background(self, coroutine):
+        """ Run the coroutine function on the event loop when the engine starts """
+        self.__tasks.append(coroutine)
 
-    def __init__(self, redis, channel):
-        """ Create the instances with redis """
-        self._redis = redis
-        self._channel = channel
-        self.__error = None
+    def execute(self, func, *args):
+        """ Run the blocking function in the bounded executor """
+        return self.loop.run_in_executor(self.__executor, func, *args)
+
+    def publish(self, channel, data):
+        """ Publish in the next batch, the future has the number of clients that got it """
+        return asyncio.wrap_future(self.publisher.publish(channel, data), loop=self.loop)
+
+    def every(self, seconds, func):
+        """ Run the blocking function in the executor every so many seconds """
+        async def clock():
+            while True:
+                start = time()
+
+                try:
+                    await self.execute(func)
+                except Exception as error:
+                    _log.error("Exception while running {0}: {1}".format(func.__name__, error))
+
+                _task_seconds.since(start, func.__name__)
+
+                await asyncio.sleep(seconds)
+
+        self.background(clock)
 
-    def clock(self):
-        """ The method that will run for ever """
-        while threading.current_thread().is_alive():
+    def run(self):
+        """ Run the event loop until it is stopped """
+        asyncio.set_event_loop(self.loop)
+        tasks = [self.loop.create_task(coroutine()) for coroutine in self.__tasks]
+        tasks.append(self.loop.create_task(self.__listen()))
+
+        try:
+            self.loop.run_forever()
+        finally:
+            # Cancel the tasks so none of them uses the executors after they shut down
+            for task in tasks:
+                task.cancel()
+
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.__reader.shutdown(wait=False)
+            self.__executor.shutdown(wait=False)
+
+    def stop(self):
+        """ Stop the event loop from any thread """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def __listen(self):
+        """ Read the pubsub connection and dispatch each message to its handler """
+        backoff = Backoff()
+
+        while True:
             try:
-                channel = self._redis.pubsub()
-                channel.subscribe(self._channel)
+                channel = self._redis.pubsub(ignore_subscribe_messages=True)
+                await self.loop.run_in_executor(self.__reader, channel.subscribe, *self.__handlers.keys())
+                backoff.reset()
 
                 if self.__error is not None:
                     self.__error = False
 
-                for data in channel.listen():
+                while True:
+                    data = await self.loop.run_in_executor(self.__reader, channel.get_message, True, 1.0)
+
                     if self.__error is not None and not self.__error:
-                        _log.error(threading.current_thread().getName() + ": Redis error fixed")
+                        _log.error('Messaging: Redis error fixed')
                         self.__error = None
 
-                    if not data['type'] == 'message':
+                    if data is None or not data['type'] == 'message':
                         continue
 
-                    try:
-                        self.process(data['data'])
-                    except Exception as error:
-                        _log.error("Exception while processing data: " + str(error))
+                    channel_name = data['channel'].decode('utf-8')
+                    self.loop.create_task(self.__dispatch(self.__handlers[channel_name], data['data']))
             except RedisError:
                 self.__error = True
-                _log.error(threading.current_thread().getName() + ": Redis error, trying again in 5 secs")
-                sleep(5)
+                _redis_errors.inc('pubsub')
+                delay = backoff.next()
+                _log.error('Messaging: Redis error, trying again in {0:.1f} secs'.format(delay))
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    async def __dispatch(messaging, data):
+        """ Dispatch the data to the handler and log any errors """
+        start = time()
+
+        try:
+            await messaging.dispatch(data)
+        except Exception as error:
+            _dispatch_errors.inc(messaging.channel)
+            _log.error("Exception while processing data: " + str(error))
+
+        _dispatch_seconds.since(start, messaging.channel)
+
+
+class Messaging:
+    """ Base class for listening on the redis channel """
+
+    def __init__(self, redis, channel, group=None):
+        """ Create the instances with redis, the channel is scoped to the group """
+        self._redis = redis
+        self.channel = grouped(channel, group)
+        self.engine = None
+
+    async def dispatch(self, data):
+        """ The coroutine the engine calls, by default process runs in the executor """
+        await self.engine.execute(self.process, data)
 
     def process(self, data):
         """ The method that will be called when processing the data """
@@ -73,35 +198,373 @@ class Messaging:
 class CreateMessaging(Messaging):
     """ Listen to the CREATE_CHANNEL and create the session """
 
-    def __init__(self, cloud, redis):
-        """ Create the instances with redis and cloud """
-        Messaging.__init__(self, redis, CREATE_CHANNEL)
+    def __init__(self, cloud, redis, admission=None):
+        """ Create the instances with redis and cloud, with admission the creates are rate limited """
+        Messaging.__init__(self, redis, CREATE_CHANNEL, cloud.group())
         self.__cloud = cloud
+        self.__claims = Claims(cloud, redis)
+        self.__batches = Batches(redis)
+        self.__admission = admission
 
-    def process(self, data):
-        """ The thread that runs and create the session based on the data """
+    async def dispatch(self, data):
+        """ Create the session in the pipeline so several creates can be in flight """
         json = JSONDecoder().decode(data.decode('utf-8'))
+        trace = self.__cloud.tracer().start(json.get('id'), 'create')
 
         try:
             hash_id = check_not_none(json['id'])
+
+            # The client can send the time of the request to see how long the delivery took
+            if 'time' in json:
+                trace.span('delivery', float(json['time']), trace.start)
+
+            if 'scripts' in json or 'count' in json:
+                await self.dispatch_batch(hash_id, json)
+                return
+
             script = check_not_none(json['script'])
+            backend = CreateMessaging.backend(json)
+            image = None
+
+            # Every cloud tracks the images so they can be pulled before they are needed
+            if default_val(backend, self.__cloud.backend()) == 'docker':
+                image = Session.docker_image(script)
+                self.__cloud.images().request(image)
+
+            trace.stage('decode')
 
-            if self.__cloud.is_server():
-                sleep(0.25)
-                session = self.__cloud.create_session(script)
-                results = {'cloud': self.__cloud.id, 'id': session.id}
-                self._redis.publish(CREATE_CHANNEL + '.' + hash_id, str(results))
+            if not self.__cloud.is_server(hash_id, image):
+                await self.__unplaced(hash_id)
+                return
+
+            trace.stage('rank')
+
+            if await self.engine.execute(self.__claims.claim, self.channel, hash_id):
+                trace.stage('claim')
+
+                if await self.admit(hash_id, json):
+                    trace.stage('admit')
+                    await self.create(hash_id, script, backend, trace, bool(json.get('trace')))
         except ValueError as error:
             _log.error('Input error: ' + str(error))
 
+    async def admit(self, hash_id, json, cost=1):
+        """ Take the cost from the buckets of the client and the group, a rejected request gets a backpressure reply """
+        if self.__admission is None:
+            return True
+
+        try:
+            wait, reason = await self.engine.execute(self.__admission.admit, json.get('client'), cost)
+        except RedisError:
+            _log.error('Admission: Redis error, admitting ' + hash_id)
+            return True
+
+        if wait == 0:
+            return True
+
+        await self.__backpressure(hash_id, reason, wait)
+        return False
+
+    async def __unplaced(self, hash_id):
+        """ When every cloud is full the one with the lowest id tells the client to back off """
+        if len(self.__cloud.available_ranks()) > 0:
+            return
+
+        if min(self.__cloud.cloud_ids(), default=self.__cloud.id) != self.__cloud.id:
+            return
+
+        if await self.engine.execute(self.__claims.claim, self.channel, hash_id):
+            await self.__backpressure(hash_id, 'capacity', 1)
+
+    async def __backpressure(self, hash_id, reason, wait):
+        """ Tell the client the request was not taken and when to try again """
+        _rejected.inc(reason)
+        results = {'cloud': self.__cloud.id, 'error': 'backpressure', 'reason': reason, 'retry_after': round(wait, 3)}
+        await self.engine.publish(self.channel + '.' + hash_id, str(results))
+
+    @staticmethod
+    def backend(json):
+        """ The backend the request picked, None to use the one in the settings """
+        backend = json.get('backend')
+
+        if backend is not None and backend not in Session.backends:
+            raise ValueError('Unknown session backend: ' + str(backend))
+
+        return backend
+
+    async def create(self, hash_id, script, backend=None, trace=None, timings=False):
+        """ Create the session in the pipeline and reply with its id, with timings the secs of each stage are sent """
+        if trace is None:
+            trace = self.__cloud.tracer().start(hash_id, 'create')
+
+        try:
+            future = self.__cloud.submit_session(script, backend, trace)
+            session = await asyncio.wrap_future(future, loop=self.engine.loop)
+            await self.engine.execute(self.__claims.own, session.id)
+            trace.stage('own')
+            results = {'cloud': self.__cloud.id, 'id': session.id}
+
+            if timings:
+                results['timings'] = {stage: round(secs, 6) for stage, secs in trace.timings().items()}
+
+            await self.engine.publish(self.channel + '.' + hash_id, str(results))
+            trace.stage('reply')
+        finally:
+            trace.finish()
+
+    async def dispatch_batch(self, hash_id, json):
+        """ The cloud that claims the batch spreads it over the clouds by their free capacity """
+        scripts = json['scripts'] if 'scripts' in json else [check_not_none(json['script'])]
+        scripts = [check_not_none(script) for script in scripts for _ in range(int(json.get('count', 1)))]
+        backend = CreateMessaging.backend(json)
+
+        if not self.__cloud.is_server(hash_id):
+            await self.__unplaced(hash_id)
+            return
+
+        if not await self.engine.execute(self.__claims.claim, self.channel, hash_id):
+            return
+
+        if not await self.admit(hash_id, json, len(scripts)):
+            return
+
+        ranks = self.__cloud.available_ranks() or [self.__cloud.generate_rank()]
+        start = 0
+
+        for cloud_id, count in Placement.spread(ranks, len(scripts)).items():
+            assigned = scripts[start:start + count]
+            start += count
+
+            if cloud_id == self.__cloud.id:
+                self.engine.loop.create_task(self.create_batch(hash_id, assigned, len(scripts), backend))
+            else:
+                request = JSONEncoder().encode({
+                    'type': 'create', 'id': hash_id, 'scripts': assigned, 'expected': len(scripts), 'backend': backend,
+                })
+                receivers = await self.engine.publish(grouped(NODE_CHANNEL, self.__cloud.group()) + '.' + cloud_id,
+                                                      request)
+
+                # The cloud is gone or not listening so the batch would never complete, create its share here
+                if receivers == 0:
+                    _log.warning('Cloud {0} did not get its part of batch {1}, creating it here'.format(
+                        cloud_id, hash_id))
+                    self.engine.loop.create_task(self.create_batch(hash_id, assigned, len(scripts), backend))
+
+        _log.info('Spread batch {0} of {1} sessions'.format(hash_id, len(scripts)))
+
+    async def create_batch(self, hash_id, scripts, expected, backend=None):
+        """ Create our part of the batch, the cloud that completes the batch sends the reply """
+        futures = [asyncio.wrap_future(self.__cloud.submit_session(script, backend), loop=self.engine.loop)
+                   for script in scripts]
+        sessions = await asyncio.gather(*futures, return_exceptions=True)
+        results = {}
+
+        for index, session in enumerate(sessions):
+            if isinstance(session, Exception):
+                results['error.' + self.__cloud.id + '.' + str(index)] = {'cloud': self.__cloud.id, 'error': str(session)}
+            else:
+                await self.engine.execute(self.__claims.own, session.id)
+                results[session.id] = {'cloud': self.__cloud.id, 'id': session.id}
+
+        collected = await self.engine.execute(self.__batches.collect, self.channel, hash_id, expected, results)
+
+        if collected is not None:
+            results = {'id': hash_id, 'sessions': collected}
+            await self.engine.publish(self.channel + '.' + hash_id, str(results))
+
+
+class CreateQueue:
+    """ Pull create requests from the CREATE_QUEUE list while this cloud has capacity """
+
+    def __init__(self, cloud, redis, create_messaging, capacity=None):
+        """ Create the instances with redis, cloud and the create handler that creates the sessions """
+        self._redis = redis
+        self.__cloud = cloud
+        self.__create_messaging = create_messaging
+        self.__capacity = default_val(capacity, 4)
+        self.queue = grouped(CREATE_QUEUE, cloud.group())
+        self.__processing = self.queue + '.processing.' + cloud.id
+        self.__heartbeat = self.queue + '.consumer.' + cloud.id
+        self.__recover_script = redis.register_script(RECOVER_SCRIPT)
+        self.__beater = ThreadPoolExecutor(max_workers=1)
+        self.__requests = set()
+        self.__error = None
+
+    async def consume(self):
+        """ Move requests to our processing list and create them, the request is acked once handled """
+        engine = self.__create_messaging.engine
+        capacity = asyncio.Semaphore(self.__capacity)
+        backoff = Backoff()
+
+        while True:
+            await capacity.acquire()
+
+            # Let clouds with room pull the requests
+            if self.__cloud.is_full():
+                capacity.release()
+                await asyncio.sleep(1)
+                continue
+
+            try:
+                data = await engine.execute(self._redis.brpoplpush, self.queue, self.__processing, 1)
+                backoff.reset()
+
+                if self.__error is not None:
+                    _log.error('Create Queue: Redis error fixed')
+                    self.__error = None
+            except RedisError:
+                capacity.release()
+                self.__error = True
+                _redis_errors.inc('queue')
+                delay = backoff.next()
+                _log.error('Create Queue: Redis error, trying again in {0:.1f} secs'.format(delay))
+                await asyncio.sleep(delay)
+                continue
+
+            if data is None:
+                capacity.release()
+            else:
+                engine.loop.create_task(self.__handle(data, capacity))
+
+    async def beat(self):
+        """ Beat on its own thread so slow creates or a full cloud never let the heartbeat expire """
+        loop = self.__create_messaging.engine.loop
+
+        while True:
+            try:
+                await loop.run_in_executor(self.__beater, self.__beat)
+            except RedisError:
+                _redis_errors.inc('queue')
+                _log.error('Create Queue: Redis error while beating')
+
+            await asyncio.sleep(CREATE_QUEUE_TTL / 5)
+
+    async def recover(self):
+        """ Put back the requests that clouds which stopped beating did not ack """
+        engine = self.__create_messaging.engine
+
+        while True:
+            try:
+                await engine.execute(self.__recover)
+            except RedisError:
+                _log.error('Create Queue: Redis error while recovering requests')
+
+            await asyncio.sleep(CREATE_QUEUE_TTL)
+
+    def __beat(self):
+        """ Let the other clouds know we are still consuming and still own the requests we hold """
+        pipe = self._redis.pipeline()
+        pipe.sadd(self.queue + '.consumers', self.__cloud.id)
+        pipe.set(self.__heartbeat, self.__cloud.id, ex=CREATE_QUEUE_TTL)
+
+        for hash_id in list(self.__requests):
+            pipe.set(self.queue + '.owner.' + hash_id, self.__cloud.id, ex=CREATE_QUEUE_TTL)
+
+        pipe.execute()
+
+    def __owned(self, data):
+        """ Check if a cloud still owns the request """
+        try:
+            hash_id = JSONDecoder().decode(data.decode('utf-8'))['id']
+        except (ValueError, KeyError, TypeError):
+            return False
+
+        return hash_id is not None and self._redis.exists(self.queue + '.owner.' + str(hash_id))
+
+    def __recover(self):
+        """ Move the requests of the dead consumers that nobody owns back on the queue """
+        for consumer in self._redis.smembers(self.queue + '.consumers'):
+            consumer = consumer.decode('utf-8')
+
+            if consumer == self.__cloud.id or self._redis.exists(self.queue + '.consumer.' + consumer):
+                continue
+
+            processing = self.queue + '.processing.' + consumer
+
+            for data in self._redis.lrange(processing, 0, -1):
+                if self.__owned(data):
+                    continue
+
+                if self.__recover_script(keys=(processing, self.queue), args=(data,)) == 1:
+                    _log.info('Create Queue: Recovered request from ' + consumer)
+
+            if self._redis.llen(processing) == 0:
+                self._redis.srem(self.queue + '.consumers', consumer)
+
+    async def __handle(self, data, capacity):
+        """ Create the session then ack the request """
+        engine = self.__create_messaging.engine
+        hash_id = None
+
+        try:
+            json = JSONDecoder().decode(data.decode('utf-8'))
+            hash_id = str(check_not_none(json['id']))
+            script = check_not_none(json['script'])
+            backend = CreateMessaging.backend(json)
+
+            # Own the request so it is not recovered while we create it
+            self.__requests.add(hash_id)
+            await engine.execute(self.__own, hash_id)
+
+            if default_val(backend, self.__cloud.backend()) == 'docker':
+                self.__cloud.images().request(Session.docker_image(script))
+
+            if await self.__create_messaging.admit(hash_id, json):
+                await self.__create_messaging.create(hash_id, script, backend)
+        except Exception as error:
+            _log.error('Create Queue: Exception while processing data: ' + str(error))
+        finally:
+            capacity.release()
+            self.__requests.discard(hash_id)
+
+        try:
+            await engine.execute(self.__ack, data, hash_id)
+        except RedisError:
+            _log.error('Create Queue: Redis error while acking request, it will be recovered')
+
+    def __own(self, hash_id):
+        """ Mark this cloud as the owner of the request """
+        self._redis.set(self.queue + '.owner.' + hash_id, self.__cloud.id, ex=CREATE_QUEUE_TTL)
+
+    def __ack(self, data, hash_id):
+        """ Remove the request from our processing list and give up owning it """
+        pipe = self._redis.pipeline()
+        pipe.lrem(self.__processing, 1, data)
+
+        if hash_id is not None:
+            pipe.delete(self.queue + '.owner.' + hash_id)
+
+        pipe.execute()
+
+
+class NodeMessaging(Messaging):
+    """ Listen to the NODE_CHANNEL of this cloud for the parts of batches that were given to us """
+
+    def __init__(self, cloud, redis, create_messaging):
+        """ Create the instances with redis, cloud and the create handler that creates the sessions """
+        Messaging.__init__(self, redis, NODE_CHANNEL + '.' + cloud.id, cloud.group())
+        self.__create_messaging = create_messaging
+
+    async def dispatch(self, data):
+        """ Create our part of the batch """
+        json = JSONDecoder().decode(data.decode('utf-8'))
+
+        if json.get('type') == 'create':
+            await self.__create_messaging.create_batch(json['id'], json['scripts'], json['expected'],
+                                                       json.get('backend'))
+        else:
+            _log.error('Unknown node request: ' + str(json.get('type')))
+
 
 class RemoveMessaging(Messaging):
     """ Listen to the REMOVE_CHANNEL and remove the session """
 
     def __init__(self, cloud, redis):
         """ Create the instances with redis and cloud """
-        Messaging.__init__(self, redis, REMOVE_CHANNEL)
+        Messaging.__init__(self, redis, REMOVE_CHANNEL, cloud.group())
         self.__cloud = cloud
+        self.__claims = Claims(cloud, redis)
+        self.__batches = Batches(redis)
 
     def process(self, data):
         """ The thread that runs and remove the session """
@@ -109,27 +572,59 @@ class RemoveMessaging(Messaging):
 
         try:
             hash_id = check_not_none(json['id'])
+
+            if 'sessions' in json:
+                self.process_batch(hash_id, [check_not_none(session) for session in json['sessions']])
+                return
+
             session = check_not_none(json['session'])
             status = self.__cloud.is_session(session)
+            claimed = (status or self.__cloud.is_server(hash_id)) and self.__claims.claim(self.channel, hash_id, session)
 
             if status:
                 self.__cloud.remove_session(session)
+                self.__claims.disown(session)
 
-            if status or (not status and self.__cloud.is_server()):
-                sleep(0.25)
+            if claimed:
                 results = {'cloud': self.__cloud.id, 'session': session, 'status': status}
-                self._redis.publish(REMOVE_CHANNEL + '.' + hash_id, str(results))
+                self.engine.publisher.publish(self.channel + '.' + hash_id, str(results))
         except ValueError as error:
             _log.error('Remove error: ' + str(error))
 
+    def process_batch(self, hash_id, sessions):
+        """ Remove the sessions we own, the cloud that claims the batch answers for sessions without an owner """
+        results = {}
+        removed, _ = self.__cloud.remove_sessions(sessions)
+
+        for session in removed:
+            results[session.id] = {'cloud': self.__cloud.id, 'session': session.id, 'status': True}
+
+        if self.__cloud.is_server(hash_id) and self.__claims.claim(self.channel, hash_id):
+            clouds = set(self.__cloud.cloud_ids())
+
+            for session in sessions:
+                if session not in results and self.__claims.owner(session) not in clouds:
+                    results[session] = {'cloud': self.__cloud.id, 'session': session, 'status': False}
+
+        # Disown after the results are in so the claiming cloud never answers for our sessions
+        collected = self.__batches.collect(self.channel, hash_id, len(set(sessions)), results) if results else None
+
+        for session in removed:
+            self.__claims.disown(session.id)
+
+        if collected is not None:
+            results = {'id': hash_id, 'sessions': collected}
+            self.engine.publisher.publish(self.channel + '.' + hash_id, str(results))
+
 
 class StatusMessaging(Messaging):
     """ Listen to the STATUS_CHANNEL and status the session """
 
     def __init__(self, cloud, redis):
         """ Create the instances with redis and cloud """
-        Messaging.__init__(self, redis, STATUS_CHANNEL)
+        Messaging.__init__(self, redis, STATUS_CHANNEL, cloud.group())
         self.__cloud = cloud
+        self.__claims = Claims(cloud, redis)
 
     def process(self, data):
         """ The thread that runs and gets the status of the session """
@@ -138,52 +633,358 @@ class StatusMessaging(Messaging):
         try:
             hash_id = check_not_none(json['id'])
             session = check_not_none(json['session'])
-            status = self.__cloud.is_session(session)
+            owned = self.__cloud.is_session(session)
 
-            if status or (not status and self.__cloud.is_server()):
-                sleep(0.25)
-                results = {'cloud': self.__cloud.id, 'id': session, 'status': status}
-                self._redis.publish(STATUS_CHANNEL + '.' + hash_id, str(results))
+            if (owned or self.__cloud.is_server(hash_id)) and self.__claims.claim(self.channel, hash_id, session):
+                results = {'cloud': self.__cloud.id, 'id': session, 'status': self.__cloud.is_alive(session)}
+                self.engine.publisher.publish(self.channel + '.' + hash_id, str(results))
         except ValueError as error:
             _log.error('Status error: ' + str(error))
 
 
+class LogsMessaging(Messaging):
+    """ Listen to the LOGS_CHANNEL and send the output of the session """
+
+    def __init__(self, cloud, redis, interval=None, chunk=None):
+        """ Create the instances with redis and cloud, followed output is sent every interval secs """
+        Messaging.__init__(self, redis, LOGS_CHANNEL, cloud.group())
+        self.__cloud = cloud
+        self.__interval = default_val(interval, 0.5)
+        self.__chunk = default_val(chunk, 500)
+
+    async def dispatch(self, data):
+        """ Only the cloud that owns the session sends its output """
+        json = JSONDecoder().decode(data.decode('utf-8'))
+
+        try:
+            hash_id = check_not_none(json['id'])
+            session = self.__cloud.get_session(check_not_none(json['session']))
+
+            if session is None:
+                return
+
+            lines = min(int(default_val(json.get('lines'), 100)), 10000)
+            follow = float(default_val(json.get('follow'), 0))
+            _, cursor = await self.engine.execute(session.follow)
+            await self.__send(hash_id, session, await self.engine.execute(session.tail, lines))
+
+            # Send the new lines in chunks until the follow time is over or the session is gone
+            deadline = time() + follow
+
+            while follow > 0 and time() < deadline and self.__cloud.get_session(session.id) is session:
+                await asyncio.sleep(self.__interval)
+                output, cursor = await self.engine.execute(session.follow, cursor)
+                await self.__send(hash_id, session, output)
+
+            if follow > 0:
+                await self.__send(hash_id, session, [], True)
+        except (ValueError, OSError) as error:
+            _log.error('Logs error: ' + str(error))
+
+    async def __send(self, hash_id, session, lines, done=False):
+        """ Publish the lines in chunks """
+        for start in range(0, len(lines), self.__chunk):
+            results = {'cloud': self.__cloud.id, 'id': session.id, 'lines': lines[start:start + self.__chunk]}
+            await self.engine.publish(self.channel + '.' + hash_id, str(results))
+
+        if done:
+            results = {'cloud': self.__cloud.id, 'id': session.id, 'lines': [], 'done': True}
+            await self.engine.publish(self.channel + '.' + hash_id, str(results))
+
+
 class RankMessaging(Messaging):
     """ Listen to the RANK_CHANNEL and process the node """
 
-    def __init__(self, cloud, redis):
+    def __init__(self, cloud, redis, encoding=None):
         """ Create the instances with redis and cloud """
-        Messaging.__init__(self, redis, RANK_CHANNEL)
+        Messaging.__init__(self, redis, RANK_CHANNEL, cloud.group())
         self.__cloud = cloud
         self.__error = None
+        self.__encoding = default_val(encoding, 'json')
+        self.__known = {}
+        self.__sync_requests = {}
+        self.__sent = None
+        self.__full_sync = True
+        self.__wake = None
+
+        if self.__encoding == 'msgpack' and msgpack is None:
+            _log.error('msgpack is not installed, sending ranks as json')
+            self.__encoding = 'json'
+
+    async def dispatch(self, data):
+        """ Rank messages are cheap so process them right on the event loop """
+        self.process(data)
 
     def process(self, data):
         """ The thread that runs and process the rank score """
-        json = JSONDecoder().decode(data.decode('utf-8'))
-        rank = Rank(json['id'], json['score'], json['time'], json['sessions'])
+        json = RankMessaging.decode(data)
+        _ranks_received.inc()
+
+        # Clouds running the first protocol always send every session
+        if 'v' not in json:
+            rank = Rank(json['id'], json['score'], json['time'], json['sessions'],
+                        full=json.get('full'), free=json.get('free'))
+        else:
+            rank = Rank(json['id'], json['score'], json['time'], self.__apply(json),
+                        full=json['full'], free=json['free'], version=json['version'], sessions_hash=json['hash'],
+                        images=json.get('images'), ports=json.get('ports'), draining=json.get('draining'))
+
         self.__cloud.add_rank(rank)
-        _log.debug('Cloud Nodes: ' + str(self.__cloud.get_ranks()))
 
-    def send(self):
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('Cloud Nodes: ' + str(self.__cloud.get_ranks()))
+
+    def request_sync(self):
+        """ Send the full session set with the next rank """
+        self.__full_sync = True
+
+    def announce(self):
+        """ Send the next rank now instead of waiting for the interval """
+        if self.__wake is not None:
+            self.__wake.set()
+
+    def __apply(self, json):
+        """ Apply the session set or delta of the rank, ask for a full sync when we are out of date """
+        cloud_id = json['id']
+        known = self.__known.get(cloud_id)
+        state = None
+
+        if 'sessions' in json:
+            state = (json['version'], json['hash'], frozenset(json['sessions']))
+        elif known is not None and known[0] == json['version']:
+            state = known
+        elif known is not None and json.get('base') == known[0]:
+            sessions = known[2].difference(json['removed']).union(json['added'])
+            ids_hash = sessions_hash(json['added'] + json['removed'], known[1])
+
+            if ids_hash == json['hash']:
+                state = (json['version'], ids_hash, sessions)
+
+        if state is None:
+            self.__request_sync(cloud_id)
+            return frozenset() if known is None else known[2]
+
+        self.__known[cloud_id] = state
+        return state[2]
+
+    def __request_sync(self, cloud_id):
+        """ Ask the cloud for its full session set at most once a second """
+        now = time()
+
+        if self.__sync_requests.get(cloud_id, 0) > now - 1:
+            return
+
+        self.__sync_requests[cloud_id] = now
+        self.engine.loop.create_task(self.__publish(grouped(RANK_SYNC_CHANNEL, self.__cloud.group()), cloud_id))
+
+    async def __publish(self, channel, data):
+        """ Publish without waiting on the result """
+        try:
+            await self.engine.publish(channel, data)
+        except RedisError:
+            _log.error('Rank Input: Redis error while asking for a full sync')
+
+    def generate(self):
+        """ Generate the rank payload, only the session changes since the last rank are included """
+        rank = self.__cloud.generate_rank()
+        json = {
+            'v': 2,
+            'id': rank.id,
+            'score': rank.score,
+            'time': rank.time,
+            'full': rank.full,
+            'free': rank.free,
+            'version': rank.version,
+            'hash': rank.sessions_hash,
+            'ports': rank.ports,
+        }
+
+        if rank.draining:
+            json['draining'] = True
+
+        if len(rank.images) > 0:
+            json['images'] = sorted(rank.images)
+
+        if self.__full_sync or self.__sent is None:
+            self.__full_sync = False
+            json['sessions'] = list(rank.sessions)
+            self.__sent = (rank.version, frozenset(rank.sessions))
+        elif self.__sent[0] != rank.version:
+            sessions = frozenset(rank.sessions)
+            json['base'] = self.__sent[0]
+            json['added'] = list(sessions - self.__sent[1])
+            json['removed'] = list(self.__sent[1] - sessions)
+            self.__sent = (rank.version, sessions)
+
+        return self.encode(json)
+
+    def encode(self, json):
+        """ Encode the payload with the encoding in the settings """
+        if self.__encoding == 'msgpack':
+            return msgpack.packb(json, use_bin_type=True)
+
+        return JSONEncoder().encode(json)
+
+    @staticmethod
+    def decode(data):
+        """ Decode the payload, json always starts with a brace """
+        if data[:1] == b'{':
+            return JSONDecoder().decode(data.decode('utf-8'))
+
+        if msgpack is None:
+            raise ValueError('msgpack is needed to decode the rank')
+
+        return msgpack.unpackb(data, raw=False)
+
+    async def send(self):
         """ Send the score to the other instances """
-        while threading.current_thread().is_alive():
-            # Remove outdated ranks
+        backoff = Backoff()
+        self.__wake = asyncio.Event()
+
+        while True:
+            # Remove outdated ranks and the sessions we know of them
             self.__cloud.remove_ranks()
+            clouds = set(self.__cloud.cloud_ids())
+
+            for cloud_id in list(self.__known):
+                if cloud_id not in clouds:
+                    del self.__known[cloud_id]
 
             # Send rank
             try:
-                json = str(self.__cloud.generate_rank())
-                self._redis.publish(self._channel, json)
-
-                if self.__error is not None:
-                    self.__error = False
+                json = self.generate()
+                start = time()
+                await self.engine.publish(self.channel, json)
+                _rank_publish_seconds.since(start)
+                _ranks_sent.inc()
+                _rank_bytes.inc(amount=len(json))
+                backoff.reset()
 
                 if self.__error is not None and not self.__error:
-                    _log.error(threading.current_thread().getName() + ": Redis error fixed")
+                    _log.error("Rank Output: Redis error fixed")
                     self.__error = None
+
+                if self.__error is not None:
+                    self.__error = False
             except RedisError:
                 self.__error = True
-                _log.error(threading.current_thread().getName() + ": Redis error, trying again in 5 secs")
-                sleep(4.5)
-            finally:
-                sleep(0.5)
+                self.__full_sync = True
+                _redis_errors.inc('rank')
+                delay = backoff.next()
+                _log.error("Rank Output: Redis error, trying again in {0:.1f} secs".format(delay))
+                await asyncio.sleep(delay)
+
+            try:
+                await asyncio.wait_for(self.__wake.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+
+            self.__wake.clear()
+
+
+class RankSyncMessaging(Messaging):
+    """ Listen to the RANK_SYNC_CHANNEL and send the full session set when a cloud asks for ours """
+
+    def __init__(self, cloud, redis, rank_messaging):
+        """ Create the instances with redis, cloud and the rank messaging that sends our rank """
+        Messaging.__init__(self, redis, RANK_SYNC_CHANNEL, cloud.group())
+        self.__cloud = cloud
+        self.__rank_messaging = rank_messaging
+
+    async def dispatch(self, data):
+        """ Sync requests are cheap so process them right on the event loop """
+        self.process(data)
+
+    def process(self, data):
+        """ Flag the next rank to include every session """
+        if data.decode('utf-8') == self.__cloud.id:
+            self.__rank_messaging.request_sync()
+
+
+class StatsMessaging(Messaging):
+    """ Listen to the STATS_CHANNEL and send the metrics of the cloud """
+
+    def __init__(self, cloud, redis):
+        """ Create the instances with redis and cloud """
+        Messaging.__init__(self, redis, STATS_CHANNEL, cloud.group())
+        self.__cloud = cloud
+
+    def process(self, data):
+        """ Every cloud replies unless the request is for one cloud """
+        json = JSONDecoder().decode(data.decode('utf-8'))
+
+        try:
+            hash_id = check_not_none(json['id'])
+
+            if json.get('cloud') in (None, self.__cloud.id):
+                results = {'cloud': self.__cloud.id, 'enabled': Metrics.enabled, 'metrics': _metrics.snapshot()}
+                self.engine.publisher.publish(self.channel + '.' + hash_id, str(results))
+        except ValueError as error:
+            _log.error('Stats error: ' + str(error))
+
+
+class DrainMessaging(Messaging):
+    """ Listen to the DRAIN_CHANNEL and drain the cloud so it can be shut down """
+
+    def __init__(self, cloud, redis, rank_messaging, grace=None):
+        """ Create the instances with redis, cloud, the rank messaging and the secs sessions get to exit """
+        Messaging.__init__(self, redis, DRAIN_CHANNEL, cloud.group())
+        self.__cloud = cloud
+        self.__rank_messaging = rank_messaging
+        self.__claims = Claims(cloud, redis)
+        self.__grace = default_val(grace, 30)
+        self.__teardown = None
+
+    async def dispatch(self, data):
+        """ Only the cloud in the request drains """
+        json = JSONDecoder().decode(data.decode('utf-8'))
+
+        try:
+            hash_id = check_not_none(json['id'])
+
+            if check_not_none(json['cloud']) == self.__cloud.id:
+                await self.drain(hash_id, float(default_val(json.get('grace'), self.__grace)))
+        except ValueError as error:
+            _log.error('Drain error: ' + str(error))
+
+    async def drain(self, hash_id=None, grace=None):
+        """ Stop taking work and tell the other clouds right away, then remove the sessions with progress """
+        channel = self.channel + '.' + default_val(hash_id, self.__cloud.id)
+
+        if self.__teardown is None:
+            self.__cloud.drain()
+            self.__rank_messaging.announce()
+            _log.info('Draining cloud {0}'.format(self.__cloud.id))
+
+            def progress(removed, total):
+                results = {'cloud': self.__cloud.id, 'total': total, 'removed': removed, 'done': False}
+                self.engine.publisher.publish(channel, str(results))
+
+            self.__teardown = self.engine.execute(self.__cloud.teardown, default_val(grace, self.__grace), progress)
+
+        sessions = await asyncio.shield(self.__teardown)
+
+        # The leader answers for the removed sessions once we no longer own them
+        try:
+            await self.engine.execute(self.__claims.disown, *(session.id for session in sessions))
+        except RedisError:
+            _redis_errors.inc('drain')
+            _log.error('Drain: Redis error while disowning the sessions')
+
+        results = {'cloud': self.__cloud.id, 'total': len(sessions), 'removed': len(sessions), 'done': True}
+        await self.engine.publish(channel, str(results))
+        _log.info('Drained {0} sessions'.format(len(sessions)))
+
+        return sessions
+
+    def shutdown(self):
+        """ Drain the cloud then stop the engine, used as the signal handler """
+        self.engine.loop.create_task(self.__shutdown())
+
+    async def __shutdown(self):
+        try:
+            await self.drain()
+        except Exception as error:
+            _log.error('Could not drain the cloud: ' + str(error))
+        finally:
+            self.engine.loop.stop()
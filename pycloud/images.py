@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Pull the docker images clouds are asked for ahead of time and evict the unused ones """
+
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import time
+from .utils import check_not_none, default_val
+import docker.errors
+
+
+_log = logging.getLogger('pycloud')
+
+
+class ImageManager:
+    """ Track the requested images in least recently used order and keep them pulled """
+
+    def __init__(self, client, budget=None, prepull=True):
+        """ Create the manager with the function that gets the docker client and the disk budget in bytes """
+        self.__client = check_not_none(client)
+        self.__budget = budget
+        self.__prepull = default_val(prepull, True)
+        self.__lock = Lock()
+        self.__requested = OrderedDict()
+        self.__cached = frozenset()
+        self.__pulls = {}
+        self.__puller = ThreadPoolExecutor(max_workers=2)
+
+    @staticmethod
+    def name(image):
+        """ Docker stores images without a tag as latest """
+        return image if ':' in image.rsplit('/', 1)[-1] else image + ':latest'
+
+    def cached(self):
+        """ The requested images that are pulled on this cloud """
+        return self.__cached
+
+    def request(self, image):
+        """ Record that a cloud was asked for the image and pull it in the background """
+        image = ImageManager.name(image)
+
+        with self.__lock:
+            self.__requested[image] = time()
+            self.__requested.move_to_end(image)
+
+        if self.__prepull and image not in self.__cached:
+            self.__pull(image)
+
+    def ensure(self, image):
+        """ Block until the image is pulled, a pull that is in flight is waited on """
+        image = ImageManager.name(image)
+
+        with self.__lock:
+            self.__requested[image] = time()
+            self.__requested.move_to_end(image)
+
+        if image not in self.__cached:
+            self.__pull(image).result()
+
+    def __pull(self, image):
+        """ Pull the image once no matter how many sessions ask for it """
+        with self.__lock:
+            future = self.__pulls.get(image)
+
+            if future is None:
+                future = self.__puller.submit(self.__download, image)
+                self.__pulls[image] = future
+
+        return future
+
+    def __download(self, image):
+        """ Pull the image unless it is already there """
+        try:
+            try:
+                self.__client().images.get(image)
+            except docker.errors.ImageNotFound:
+                _log.info('Pulling docker image: ' + image)
+                self.__client().images.pull(image)
+
+            with self.__lock:
+                self.__cached = self.__cached.union((image,))
+        finally:
+            with self.__lock:
+                del self.__pulls[image]
+
+    def maintain(self):
+        """ Refresh the pulled images, pull the requested ones and evict the least recently used """
+        images = self.__client().images.list()
+        tags = {tag: image for image in images for tag in image.tags}
+
+        with self.__lock:
+            requested = list(self.__requested)
+            self.__cached = frozenset(image for image in requested if image in tags)
+
+        if self.__prepull:
+            for image in requested:
+                if image not in tags:
+                    self.__pull(image)
+
+        if self.__budget is None:
+            return
+
+        in_use = set(container.attrs['Image'] for container in self.__client().containers.list(all=True))
+        used = sum(image.attrs['Size'] for image in images)
+
+        # Least recently requested first, only images that we pulled are evicted
+        for image in requested:
+            if used <= self.__budget:
+                break
+
+            if image not in tags or tags[image].id in in_use:
+                continue
+
+            _log.info('Evicting docker image: ' + image)
+
+            try:
+                self.__client().images.remove(image)
+                used -= tags[image].attrs['Size']
+            except docker.errors.APIError as error:
+                _log.error('Could not evict docker image {0}: {1}'.format(image, error))
+                continue
+
+            with self.__lock:
+                self.__requested.pop(image, None)
+                self.__cached = self.__cached.difference((image,))
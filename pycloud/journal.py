@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Journal the sessions so a daemon that restarts can take them over """
+
+import os
+import logging
+import hashlib
+from threading import Lock
+from json import JSONEncoder, JSONDecoder
+from time import time
+
+
+_log = logging.getLogger('pycloud')
+
+
+class Journal:
+    """ An append only file of the sessions that were added and removed, one json record per line """
+
+    def __init__(self, path=None, fsync=False):
+        """ Use the journal at the path, without a path nothing is recorded """
+        self.path = path
+        self.__fsync = bool(fsync)
+        self.__lock = Lock()
+        self.__fd = None
+        self.__sessions = {}
+        self.__records = 0
+
+    def __len__(self):
+        """ The number of sessions in the journal """
+        return len(self.__sessions)
+
+    @staticmethod
+    def script_hash(script):
+        """ The hash of the script so a session folder that was reused is not taken over """
+        return hashlib.sha1(script.encode('utf-8')).hexdigest()
+
+    def replay(self):
+        """ Read the sessions that were added and not removed by id, a torn record from a crash is skipped """
+        sessions = {}
+
+        if self.path is None or not os.path.exists(self.path):
+            return sessions
+
+        decoder = JSONDecoder()
+
+        with open(self.path, 'rb') as file:
+            for line in file:
+                try:
+                    record = decoder.decode(line.decode('utf-8'))
+                except ValueError:
+                    _log.error('Skipping a broken record in the journal')
+                    continue
+
+                if record.get('op') == 'remove':
+                    sessions.pop(record['id'], None)
+                else:
+                    sessions[record['id']] = record
+
+        return sessions
+
+    def add(self, session):
+        """ Record the session or its new pid after a restart """
+        if self.path is None:
+            return
+
+        record = dict(session.state(), op='add', time=time())
+
+        with self.__lock:
+            self.__sessions[session.id] = record
+            self.__append((record,))
+
+    def remove(self, session_ids):
+        """ Record that the sessions are gone """
+        if self.path is None:
+            return
+
+        with self.__lock:
+            records = [{'op': 'remove', 'id': session_id} for session_id in session_ids
+                       if self.__sessions.pop(session_id, None) is not None]
+
+            if len(records) > 0:
+                self.__append(records)
+
+    def reset(self, sessions):
+        """ Start the journal over with only the sessions, the records of the old daemon are dropped """
+        if self.path is None:
+            return
+
+        with self.__lock:
+            self.__sessions = {session.id: dict(session.state(), op='add', time=time()) for session in sessions}
+            self.__compact()
+
+    def __append(self, records):
+        """ Write the records in one write so a crash can only tear the last one, must hold the lock """
+        data = ''.join(JSONEncoder().encode(record) + '\n' for record in records).encode('utf-8')
+
+        try:
+            if self.__fd is None:
+                self.__fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+            os.write(self.__fd, data)
+
+            if self.__fsync:
+                os.fsync(self.__fd)
+        except OSError as error:
+            _log.error('Could not write the journal: ' + str(error))
+            return
+
+        # Rewrite the journal when most of it is sessions that are gone
+        self.__records += len(records)
+
+        if self.__records > 2 * len(self.__sessions) + 64:
+            self.__compact()
+
+    def __compact(self):
+        """ Replace the journal with a record for each session, must hold the lock """
+        temp = self.path + '.tmp'
+        data = ''.join(JSONEncoder().encode(record) + '\n' for record in self.__sessions.values()).encode('utf-8')
+
+        try:
+            with open(temp, 'wb') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+
+            os.replace(temp, self.path)
+        except OSError as error:
+            _log.error('Could not compact the journal: ' + str(error))
+            return
+
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+        self.__records = len(self.__sessions)
@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Counters, gauges and histograms of the hot paths, they do nothing until the metrics are enabled """
+
+import logging
+from bisect import bisect_left
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import time
+from .utils import check_not_none, default_val
+
+
+_log = logging.getLogger('pycloud')
+
+
+class Metrics:
+    """ The registry of every metric, exposed in the prometheus text format """
+
+    __inst = None
+    enabled = False
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__metrics = {}
+        self.__server = None
+
+    @staticmethod
+    def get():
+        """ Get the registry all the modules share """
+        if Metrics.__inst is None:
+            Metrics.__inst = Metrics()
+
+        return Metrics.__inst
+
+    @staticmethod
+    def configure(enabled=None):
+        """ Turn the metrics on or off, while they are off recording a value only checks this flag """
+        Metrics.enabled = bool(default_val(enabled, Metrics.enabled))
+
+    def counter(self, name, help_text, labels=()):
+        """ Get the counter with the name, it is created the first time """
+        return self.__register(name, lambda: Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), func=None):
+        """ Get the gauge with the name, a gauge with a func reads its values when it is collected """
+        return self.__register(name, lambda: Gauge(name, help_text, labels, func))
+
+    def histogram(self, name, help_text, labels=(), buckets=None):
+        """ Get the histogram with the name, it is created the first time """
+        return self.__register(name, lambda: Histogram(name, help_text, labels, buckets))
+
+    def __register(self, name, factory):
+        with self.__lock:
+            if name not in self.__metrics:
+                self.__metrics[name] = factory()
+
+            return self.__metrics[name]
+
+    def metrics(self):
+        """ Get all the metrics sorted by name """
+        with self.__lock:
+            return [self.__metrics[name] for name in sorted(self.__metrics)]
+
+    def render(self):
+        """ The metrics in the prometheus text format """
+        lines = []
+
+        for metric in self.metrics():
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """ The values of the metrics by name and labels, histograms only have their count and sum """
+        return {metric.name: metric.snapshot() for metric in self.metrics()}
+
+    def serve(self, port, host=None):
+        """ Serve the metrics on http://host:port/metrics in a daemon thread """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.__server = MetricsServer((default_val(host, '127.0.0.1'), int(port)), Handler)
+        thread = Thread(target=self.__server.serve_forever, name='PyCloud Metrics Thread', daemon=True)
+        thread.start()
+        _log.info('Serving metrics on port {0}'.format(self.__server.server_address[1]))
+
+        return self.__server.server_address[1]
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """ Answer each scrape in its own thread """
+    daemon_threads = True
+
+
+class Metric:
+    """ The base of the metrics, the values are kept by the tuple of label values """
+    type = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = check_not_none(name)
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        self._values = {}
+
+    def _series(self, suffix='', values=(), extra=()):
+        """ The series name with the labels """
+        pairs = list(zip(self.labels, values)) + list(extra)
+
+        if len(pairs) == 0:
+            return self.name + suffix
+
+        return '{0}{1}{{{2}}}'.format(self.name, suffix, ','.join(
+            '{0}="{1}"'.format(label, Metric.escape(value)) for label, value in pairs
+        ))
+
+    @staticmethod
+    def escape(value):
+        """ Escape the label value for the text format """
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def _items(self):
+        with self._lock:
+            items = [(labels, list(value) if isinstance(value, list) else value)
+                     for labels, value in self._values.items()]
+
+        return sorted(items, key=lambda item: tuple(str(value) for value in item[0]))
+
+    def render(self):
+        return ['{0} {1}'.format(self._series('', labels), value) for labels, value in self._items()]
+
+    def snapshot(self):
+        """ The values by the label values joined with commas, a metric without labels is just its value """
+        values = {','.join(str(value) for value in labels): self._summary(value) for labels, value in self._items()}
+        return values.get('') if len(self.labels) == 0 else values
+
+    def _summary(self, value):
+        return value
+
+
+class Counter(Metric):
+    """ A value that only goes up """
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        """ Add to the counter of the label values """
+        if not Metrics.enabled:
+            return
+
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """ A value that goes up and down, or the values the func returns by the label values """
+    type = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), func=None):
+        Metric.__init__(self, name, help_text, labels)
+        self.__func = func
+
+    def set(self, value, *labels):
+        """ Set the gauge of the label values """
+        if not Metrics.enabled:
+            return
+
+        with self._lock:
+            self._values[labels] = value
+
+    def _items(self):
+        if self.__func is None:
+            return Metric._items(self)
+
+        try:
+            values = self.__func()
+        except Exception as error:
+            _log.error('Could not read the gauge {0}: {1}'.format(self.name, error))
+            return []
+
+        if not isinstance(values, dict):
+            return [((), values)]
+
+        return sorted(((labels if isinstance(labels, tuple) else (labels,), value)
+                       for labels, value in values.items()), key=lambda item: tuple(str(label) for label in item[0]))
+
+
+class Histogram(Metric):
+    """ The count of the values in each bucket with their sum """
+    type = 'histogram'
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, labels=(), buckets=None):
+        Metric.__init__(self, name, help_text, labels)
+        self.buckets = tuple(sorted(default_val(buckets, Histogram.buckets)))
+
+    def observe(self, value, *labels):
+        """ Count the value in the first bucket it fits in """
+        if not Metrics.enabled:
+            return
+
+        index = bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(labels)
+
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            counts[index] += 1
+            counts[-1] += value
+
+    def since(self, start, *labels):
+        """ Observe the secs since the start time """
+        if Metrics.enabled:
+            self.observe(time() - start, *labels)
+
+    def render(self):
+        lines = []
+
+        for labels, counts in self._items():
+            total = 0
+
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append('{0} {1}'.format(self._series('_bucket', labels, (('le', bound),)), total))
+
+            lines.append('{0} {1}'.format(self._series('_sum', labels), counts[-1]))
+            lines.append('{0} {1}'.format(self._series('_count', labels), total))
+
+        return lines
+
+    def _summary(self, counts):
+        return {'count': sum(counts[:-1]), 'sum': counts[-1]}
+
+
+class TimedLock:
+    """ A lock that records how long it took to get it when the metrics are enabled """
+
+    def __init__(self, histogram, name):
+        self.__lock = Lock()
+        self.__histogram = histogram
+        self.__name = name
+
+    def __enter__(self):
+        if not Metrics.enabled:
+            return self.__lock.__enter__()
+
+        start = time()
+        self.__lock.acquire()
+        self.__histogram.observe(time() - start, self.__name)
+        return True
+
+    def __exit__(self, *args):
+        self.__lock.release()
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Keep the output of the sessions without letting it grow for ever """
+
+import logging
+import mmap
+import os
+import select
+from threading import Lock, Thread
+from .utils import default_val
+
+
+_log = logging.getLogger('pycloud')
+
+
+class RotatingLog:
+    """ A log file that is moved to path.1 when it is full, the oldest of count files is dropped """
+
+    def __init__(self, path, size=None, count=None):
+        """ Open the log at path that rotates once it has size bytes """
+        self.path = path
+        self.size = int(default_val(size, 10 * 1024 * 1024))
+        self.count = int(default_val(count, 3))
+        self.__file = open(self.path, 'ab', buffering=0)
+        self.__written = self.__file.tell()
+
+    def write(self, data):
+        """ Write the data, rotating first when it does not fit """
+        if self.__written > 0 and self.__written + len(data) > self.size:
+            self.rotate()
+
+        self.__file.write(data)
+        self.__written += len(data)
+
+    def rotate(self):
+        """ Move every file up by one and start a new log """
+        self.__file.close()
+
+        for index in range(self.count - 1, 0, -1):
+            older = '{0}.{1}'.format(self.path, index)
+
+            if os.path.exists(older):
+                os.replace(older, '{0}.{1}'.format(self.path, index + 1))
+
+        if self.count > 0:
+            os.replace(self.path, self.path + '.1')
+
+        self.__file = open(self.path, 'wb', buffering=0)
+        self.__written = 0
+
+    def close(self):
+        """ Close the log file """
+        self.__file.close()
+
+
+class RingBuffer:
+    """ The last size bytes of the output, in memory or in a file under the session folder mapped in memory """
+
+    def __init__(self, size=None, path=None):
+        """ Create the buffer, when there is a path the buffer is that file mapped in memory """
+        self.size = int(default_val(size, 64 * 1024))
+        self.path = path
+        self.__lock = Lock()
+        self.__written = 0
+
+        if path is None:
+            self.__buffer = bytearray(self.size)
+        else:
+            with open(path, 'w+b') as file:
+                file.truncate(self.size)
+                self.__buffer = mmap.mmap(file.fileno(), self.size)
+
+    def write(self, data):
+        """ Write the data over the oldest bytes, writes after close are dropped """
+        with self.__lock:
+            if self.__buffer is None:
+                return
+
+            # Only the end of a write larger than the buffer is kept
+            if len(data) > self.size:
+                self.__written += len(data) - self.size
+                data = data[-self.size:]
+
+            start = self.__written % self.size
+            first = min(len(data), self.size - start)
+            self.__buffer[start:start + first] = data[:first]
+            self.__buffer[:len(data) - first] = data[first:]
+            self.__written += len(data)
+
+    def read(self, offset=None):
+        """ Get the bytes written since the offset that are still in the buffer and the offset of the end """
+        with self.__lock:
+            end = self.__written
+            begin = min(max(end - self.size, default_val(offset, 0)), end)
+
+            if self.__buffer is None:
+                return b'', end
+
+            start = begin % self.size
+            length = end - begin
+
+            if start + length <= self.size:
+                data = bytes(self.__buffer[start:start + length])
+            else:
+                data = bytes(self.__buffer[start:]) + bytes(self.__buffer[:length - (self.size - start)])
+
+        return data, end
+
+    def tail(self, lines):
+        """ Get the last lines, the first line is dropped when it was cut by the wrap around """
+        data, end = self.read()
+        text = data.decode('utf-8', 'replace').splitlines()
+
+        if end > self.size and len(text) > 0:
+            text = text[1:]
+
+        return text[-lines:] if lines > 0 else []
+
+    def lines(self, offset):
+        """ Get the whole lines written since the offset and the offset after the last of them """
+        data, end = self.read(offset)
+        cut = data.rfind(b'\n') + 1
+
+        return data[:cut].decode('utf-8', 'replace').splitlines(), end - len(data) + cut
+
+    def offset(self):
+        """ The offset of the end of the output """
+        return self.__written
+
+    def close(self):
+        """ Release the buffer """
+        with self.__lock:
+            if isinstance(self.__buffer, mmap.mmap):
+                self.__buffer.close()
+
+            self.__buffer = None
+
+
+class OutputPump:
+    """ Copy the output of every session from its pipe to its sinks with one epoll in one thread """
+
+    def __init__(self):
+        """ The thread is started with the first pipe """
+        self.__lock = Lock()
+        self.__epoll = select.epoll()
+        self.__pipes = {}
+        self.__thread = None
+
+    def add(self, fd, sinks, close=None, owner=None):
+        """ Copy what is read from the fd to the sinks, close is called once the fd ends or is removed """
+        os.set_blocking(fd, False)
+
+        with self.__lock:
+            self.__pipes[fd] = (tuple(sinks), close, owner)
+            self.__epoll.register(fd, select.EPOLLIN)
+
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name='PyCloud Output Thread', daemon=True)
+                self.__thread.start()
+
+    def remove(self, fd, owner=None):
+        """ Stop copying from the fd, with an owner only when the fd was added by it as the fd may be reused """
+        with self.__lock:
+            pipe = self.__pipes.get(fd)
+
+            if pipe is None or (owner is not None and pipe[2] is not owner):
+                return
+
+            del self.__pipes[fd]
+            self.__epoll.unregister(fd)
+
+        if pipe[1] is not None:
+            pipe[1]()
+
+    def __run(self):
+        """ Copy the output of the pipes that are ready """
+        while True:
+            for fd, _ in self.__epoll.poll():
+                with self.__lock:
+                    pipe = self.__pipes.get(fd)
+
+                if pipe is not None:
+                    self.__copy(fd, pipe[0])
+
+    def __copy(self, fd, sinks):
+        """ Copy one read to the sinks, the fd is removed at the end of its output """
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if len(data) == 0:
+            self.remove(fd)
+            return
+
+        for sink in sinks:
+            try:
+                sink.write(data)
+            except (OSError, ValueError) as error:
+                _log.error('Could not write the session output: ' + str(error))
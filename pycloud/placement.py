@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Strategies that decide which cloud owns a request """
+
+import heapq
+import random
+from bisect import bisect
+from .utils import stable_hash
+
+
+class Placement:
+    """ Base class that picks the rank that owns a request """
+
+    def owner(self, table, key=None):
+        """ Get the rank that owns the request from the rank table """
+        raise NotImplementedError()
+
+    @staticmethod
+    def weight(rank):
+        """ The free capacity of the rank, the higher the more work it gets """
+        if rank.free is not None:
+            return max(rank.free, 0)
+
+        return 1.0 / (1.0 + max(rank.score, 0))
+
+    @staticmethod
+    def spread(ranks, count):
+        """ Spread the count over the ranks by their free capacity, returns the count for each cloud id """
+        weights = [(rank.id, Placement.weight(rank)) for rank in ranks]
+
+        if sum(weight for _, weight in weights) <= 0:
+            weights = [(cloud_id, 1.0) for cloud_id, _ in weights]
+
+        # Give each one to the cloud with the most free capacity left over
+        assigned = {cloud_id: 0 for cloud_id, _ in weights}
+        heap = [(-weight, cloud_id, weight) for cloud_id, weight in weights]
+        heapq.heapify(heap)
+
+        for _ in range(count if len(heap) > 0 else 0):
+            _, cloud_id, weight = heapq.heappop(heap)
+            assigned[cloud_id] += 1
+            heapq.heappush(heap, (-weight / (assigned[cloud_id] + 1), cloud_id, weight))
+
+        return {cloud_id: count for cloud_id, count in assigned.items() if count > 0}
+
+    @staticmethod
+    def get(name=None):
+        """ Get the placement strategy by its name in the settings """
+        strategies = {
+            'lowest': LowestRank,
+            'two-choices': PowerOfTwoChoices,
+            'weighted': WeightedRandom,
+            'hash': ConsistentHash,
+        }
+
+        if name is None:
+            name = 'lowest'
+
+        if name not in strategies:
+            raise ValueError('Unknown placement strategy: ' + str(name))
+
+        return strategies[name]()
+
+
+class LowestRank(Placement):
+    """ Always pick the rank with the lowest score """
+
+    def owner(self, table, key=None):
+        return table.leader()
+
+
+class PowerOfTwoChoices(Placement):
+    """ Pick two ranks from the request key and use the one with the lower score """
+
+    def owner(self, table, key=None):
+        ranks = table.available()
+
+        if len(ranks) < 2 or key is None:
+            return table.leader()
+
+        by_id = sorted(ranks, key=lambda rank: rank.id)
+        index = stable_hash(key, 0) % len(by_id)
+
+        # The second pick is one of the other ranks so there are always two to choose from
+        first = by_id[index]
+        second = by_id[(index + 1 + stable_hash(key, 1) % (len(by_id) - 1)) % len(by_id)]
+
+        return min((first, second), key=lambda rank: (rank.score, rank.id))
+
+
+class WeightedRandom(Placement):
+    """ Pick a random rank seeded by the request key, weighted by free capacity """
+
+    def owner(self, table, key=None):
+        ranks = table.available()
+
+        if len(ranks) < 2 or key is None:
+            return table.leader()
+
+        by_id = sorted(ranks, key=lambda rank: rank.id)
+        weights = [Placement.weight(rank) for rank in by_id]
+        point = random.Random(stable_hash(key)).random() * sum(weights)
+
+        for rank, weight in zip(by_id, weights):
+            point -= weight
+
+            if point < 0:
+                return rank
+
+        return by_id[-1]
+
+
+class ConsistentHash(Placement):
+    """ Place the request key on a hash ring of the clouds """
+
+    def __init__(self, replicas=64):
+        self.__replicas = replicas
+        self.__ring = (frozenset(), (), ())
+
+    def owner(self, table, key=None):
+        ranks = table.available()
+
+        if len(ranks) < 2 or key is None:
+            return table.leader()
+
+        clouds = {rank.id: rank for rank in ranks}
+        ring = self.__ring
+
+        # Only rebuild the ring when the clouds change, swap it in at once for other threads
+        if ring[0] != frozenset(clouds):
+            nodes = sorted((stable_hash(cloud, replica), cloud)
+                           for cloud in clouds for replica in range(self.__replicas))
+            ring = (frozenset(clouds), tuple(cloud for _, cloud in nodes), tuple(point for point, _ in nodes))
+            self.__ring = ring
+
+        index = bisect(ring[2], stable_hash(key)) % len(ring[1])
+
+        return clouds[ring[1][index]]
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Keep sessions prepared ahead of time so a create only has to launch them """
+
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from .utils import check_not_none, default_val
+
+
+_log = logging.getLogger('pycloud')
+
+
+class WarmPool:
+    """ A pool of prewarmed sessions for each script template """
+
+    def __init__(self, cloud, templates=None):
+        """ Create the pool for the templates, each with the script and how many to keep ready """
+        self.__cloud = check_not_none(cloud)
+        self.__lock = Lock()
+        self.__replenisher = ThreadPoolExecutor(max_workers=1)
+        self.__sizes = {}
+        self.__sessions = {}
+        self.__pending = {}
+        self.__drained = False
+
+        for template in default_val(templates, []):
+            script = check_not_none(template.get('script'), 'Pool template must include a script')
+            self.__sizes[script] = int(default_val(template.get('size'), 1))
+            self.__sessions[script] = deque()
+            self.__pending[script] = 0
+
+    def __len__(self):
+        return sum(len(sessions) for sessions in self.__sessions.values())
+
+    def take(self, script):
+        """ Take a prewarmed session for the script, None when there is none ready """
+        if script not in self.__sizes:
+            return None
+
+        with self.__lock:
+            sessions = self.__sessions[script]
+            session = sessions.popleft() if len(sessions) > 0 else None
+
+        if not self.__drained:
+            self.__replenisher.submit(self.replenish, script)
+
+        return session
+
+    def replenish(self, script=None):
+        """ Prewarm sessions until the pool of the script, or of every script, is full """
+        for template in list(self.__sizes) if script is None else (script,):
+            while True:
+                with self.__lock:
+                    if self.__drained:
+                        return
+
+                    if len(self.__sessions[template]) + self.__pending[template] >= self.__sizes[template]:
+                        break
+
+                    self.__pending[template] += 1
+
+                session = None
+
+                try:
+                    # Reserving the port can fail too, the pending count is given back either way
+                    session = self.__cloud.session_type(self.__cloud, template)
+                    session.create()
+                    session.prewarm()
+
+                    with self.__lock:
+                        drained = self.__drained
+
+                        if not drained:
+                            self.__sessions[template].append(session)
+
+                    # The pool was drained while the session was prewarming
+                    if drained:
+                        session.remove()
+                except Exception as error:
+                    _log.error('Could not prewarm session: ' + str(error))
+
+                    if session is not None:
+                        session.remove()
+
+                    break
+                finally:
+                    with self.__lock:
+                        self.__pending[template] -= 1
+
+    def submit_replenish(self):
+        """ Prewarm every template in the background """
+        return self.__replenisher.submit(self.replenish)
+
+    def drain(self):
+        """ Remove all the prewarmed sessions and stop prewarming new ones """
+        with self.__lock:
+            self.__drained = True
+            sessions = [session for pool in self.__sessions.values() for session in pool]
+
+            for pool in self.__sessions.values():
+                pool.clear()
+
+        for session in sessions:
+            session.remove()
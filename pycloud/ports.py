@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Hand out the ports of the sessions from a reserved range """
+
+from collections import deque
+from threading import Lock
+from .utils import default_val
+
+
+class PortAllocator:
+    """ A free list of the ports in the range, released ports go to the back so they are reused last """
+
+    def __init__(self, start=None, end=None):
+        """ Create the allocator for the ports from start to end inclusive """
+        self.start = int(default_val(start, 30000))
+        self.end = int(default_val(end, 30999))
+
+        if self.end < self.start:
+            raise ValueError('The port range ends before it starts')
+
+        self.__lock = Lock()
+        self.__free = deque(range(self.start, self.end + 1))
+        self.__available = set(self.__free)
+
+    def __len__(self):
+        """ The number of ports that are free """
+        return len(self.__free)
+
+    def allocate(self):
+        """ Take a free port """
+        with self.__lock:
+            if len(self.__free) == 0:
+                raise ValueError('No free ports between {0} and {1}'.format(self.start, self.end))
+
+            port = self.__free.popleft()
+            self.__available.discard(port)
+
+        return port
+
+    def reserve(self, port):
+        """ Take the port a session already has, False when it is outside the range or not free """
+        with self.__lock:
+            if port not in self.__available:
+                return False
+
+            self.__free.remove(port)
+            self.__available.discard(port)
+
+        return True
+
+    def release(self, port):
+        """ Give the port back, ports outside the range or already free are ignored """
+        with self.__lock:
+            if self.start <= port <= self.end and port not in self.__available:
+                self.__free.append(port)
+                self.__available.add(port)
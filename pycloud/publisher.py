@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Send the publishes of every handler in pipelines """
+
+import logging
+from concurrent.futures import Future
+from threading import Condition, Thread
+from time import time
+from redis.exceptions import RedisError
+from .utils import check_not_none, default_val
+from .metrics import Metrics
+
+
+_log = logging.getLogger('pycloud')
+_metrics = Metrics.get()
+_batch_size = _metrics.histogram('pycloud_publish_batch_size', 'Publishes sent in each pipeline', (),
+                                 (1, 2, 5, 10, 20, 50, 100, 200, 500))
+_publish_errors = _metrics.counter('pycloud_publish_errors_total', 'Publishes that failed')
+
+
+class Publisher:
+    """ Collect the publishes made while a batch is in flight or within window secs and send them in one pipeline """
+
+    def __init__(self, redis, window=None, size=None):
+        """ Create the publisher, a batch is sent once the window is over or it has size publishes """
+        self.__redis = check_not_none(redis)
+        self.window = default_val(window, 0)
+        self.size = default_val(size, 100)
+        self.__condition = Condition()
+        self.__pending = []
+        self.__thread = None
+
+    def publish(self, channel, data):
+        """ Queue the publish from any thread, the future has the number of clients that got it """
+        future = Future()
+
+        with self.__condition:
+            self.__pending.append((channel, data, future))
+
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name='PyCloud Publisher Thread', daemon=True)
+                self.__thread.start()
+
+            if len(self.__pending) == 1 or len(self.__pending) >= self.size:
+                self.__condition.notify()
+
+        return future
+
+    def __run(self):
+        """ Send the batches for ever """
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: len(self.__pending) > 0)
+
+                # Give the other handlers the window to add their publishes
+                deadline = time() + self.window
+
+                while len(self.__pending) < self.size and time() < deadline:
+                    self.__condition.wait(deadline - time())
+
+                batch = self.__pending[:self.size]
+                del self.__pending[:self.size]
+
+            self.__send(batch)
+
+    def __send(self, batch):
+        """ Send the batch in one round trip """
+        pipe = self.__redis.pipeline(transaction=False)
+        _batch_size.observe(len(batch))
+
+        for channel, data, _ in batch:
+            pipe.publish(channel, data)
+
+        try:
+            results = pipe.execute()
+        except RedisError as error:
+            _log.error('Publisher: Redis error while sending {0} messages'.format(len(batch)))
+            _publish_errors.inc(amount=len(batch))
+
+            for _, _, future in batch:
+                future.set_exception(error)
+
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
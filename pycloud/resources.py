@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Account for the resources the host and each session are using """
+
+import logging
+from .utils import check_not_none, default_val
+import psutil
+
+
+_log = logging.getLogger('pycloud')
+
+
+class ResourceMonitor:
+    """ Sample the host and session usage in the background and smooth the host load """
+
+    def __init__(self, cloud, max_sessions=None, reserved=None, alpha=None):
+        """ Create the monitor for the cloud with its capacity limits """
+        self.__cloud = check_not_none(cloud)
+        self.max_sessions = default_val(max_sessions, 100)
+        self.reserved = default_val(reserved, 10)
+        self.__alpha = default_val(alpha, 0.3)
+        self.__cpu_count = psutil.cpu_count() or 1
+        self.__memory = psutil.virtual_memory().total
+        self.load = None
+        self.session_load = 0.0
+
+        # Prime the cpu counter so the first sample covers the interval
+        psutil.cpu_percent(interval=None)
+
+    def sample(self):
+        """ Sample the host load and the load of each session, the docker stats calls block so run it off the loop """
+        self.__sample_host()
+        total = 0.0
+        sessions = 0
+
+        for session_id in self.__cloud.sessions():
+            session = self.__cloud.get_session(session_id)
+
+            if session is None:
+                continue
+
+            try:
+                cpu, memory = session.usage()
+            except Exception as error:
+                _log.debug('Could not sample session {0}: {1}'.format(session_id, error))
+                continue
+
+            total += (cpu / self.__cpu_count + memory * 100.0 / self.__memory) / 2
+            sessions += 1
+
+        # Without any sessions left there is no cost per session to limit by
+        self.session_load = total / sessions if sessions > 0 else 0.0
+
+    def __sample_host(self):
+        """ Sample the host load and smooth it, this never blocks """
+        load = (psutil.cpu_percent(interval=None) + psutil.virtual_memory().percent) / 2
+        self.load = load if self.load is None else self.__alpha * load + (1 - self.__alpha) * self.load
+
+    def host_load(self):
+        """ The smoothed host load, only sample the host if there is none yet """
+        if self.load is None:
+            self.__sample_host()
+
+        return self.load
+
+    def free(self):
+        """ How many more sessions this cloud can take before it is full """
+        count = self.__cloud.session_count() - self.__cloud.supervisor().restarting()
+        free = min(self.max_sessions - count, len(self.__cloud.ports()))
+        headroom = 100 - self.reserved - self.host_load()
+
+        # Limit by the load the average session is adding to the host
+        if self.session_load > 0:
+            free = min(free, int(headroom / self.session_load))
+        elif headroom <= 0:
+            free = 0
+
+        return max(free, 0)
+
+    def is_full(self):
+        """ Is this cloud saturated and should not get more work """
+        return self.free() <= 0
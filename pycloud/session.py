@@ -18,39 +18,101 @@
 
 import subprocess
 import os
+import shlex
+import signal
+import select
 import logging
 import socket
 import docker
 import docker.errors
+import psutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial
+from threading import Lock, Thread, Event
+from time import time, sleep
 from json import JSONEncoder, JSONDecoder
 from .constants import DATA_DIR
 from .utils import check_not_none, generate_id, remove, default_val
+from .journal import Journal
+from .metrics import Metrics
+from .output import RotatingLog, RingBuffer, OutputPump
 
 
 _log = logging.getLogger('pycloud')
+_metrics = Metrics.get()
+_start_seconds = _metrics.histogram('pycloud_session_start_seconds', 'Time to start a session', ('backend',))
+_remove_seconds = _metrics.histogram('pycloud_session_remove_seconds', 'Time to remove a session', ('backend',))
 
 
 class Session:
     """ The session object that represents the session """
     __use_docker = os.environ.get('PYCLOUD_USE_DOCKER') is not None
+    backends = ('tmux', 'docker', 'native')
+    output_size = 64 * 1024
+    output_mmap = False
+    __pump = None
+    __lock = Lock()
 
-    def __init__(self, cloud, script):
-        """ Generate this session with the cloud instance """
-        self.id = generate_id()
+    def __init__(self, cloud, script, backend=None, hash_id=None, port=None):
+        """ Generate this session with the cloud instance, the backend defaults to the one in the settings,
+            a session taken over from the journal keeps its id and port """
+        self.id = generate_id() if hash_id is None else hash_id
         self.__pid = -1
         self.__cloud = check_not_none(cloud)
         self.__script = check_not_none(script)
+        self.backend = default_val(backend, cloud.backend())
+
+        if self.backend not in Session.backends:
+            raise ValueError('Unknown session backend: ' + str(self.backend))
+
         self._session_dir = DATA_DIR + self.id + '/'
         self._session_script = self._session_dir + 'pycloud.init'
         self._session_config = self._session_dir + 'pycloud.json'
+        self._session_log = self._session_dir + 'output.log'
+        self.timings = None
+        self.trace = None
+        self.__warm = False
+        self.__processes = {}
+        self.alive = True
+        self.restarts = 0
+        self.output = None
+        self.__fifo = None
+        self.__docker_stats = None
 
-        # Grab an ephemeral port to use, if failed use port 0
-        try:
-            with socket.socket() as connection:
-                connection.bind(('', 0))
-                self._port = connection.getsockname()[1]
-        except OSError:
-            self._port = 0
+        # Take a port from the range the cloud reserved for the sessions
+        if port is None:
+            self._port = self.__cloud.ports().allocate()
+        else:
+            self._port = port
+
+            if not self.__cloud.ports().reserve(port):
+                _log.warning('Port {0} of session {1} is not free in the port range'.format(port, self.id))
+
+    @staticmethod
+    def uses_docker():
+        """ Are the sessions forced to be docker containers whatever backend the request picks """
+        return Session.__use_docker
+
+    @staticmethod
+    def configure(output_size=None, output_mmap=None):
+        """ Set the bytes of output kept for each session and if it is kept in a file mapped in memory """
+        Session.output_size = default_val(output_size, Session.output_size)
+        Session.output_mmap = default_val(output_mmap, Session.output_mmap)
+
+    @staticmethod
+    def pump():
+        """ The pump that copies the output of every session """
+        with Session.__lock:
+            if Session.__pump is None:
+                Session.__pump = OutputPump()
+
+            return Session.__pump
+
+    @staticmethod
+    def docker_image(script):
+        """ The docker image is the first line of the script """
+        return script.split('\n', 1)[0].strip()
 
     def create(self):
         """ Create the session """
@@ -66,47 +128,268 @@ class Session:
             for line in self.__script.split('\n'):
                 print(line, file=file)
 
-        os.chdir(self._session_dir)
         os.chmod(self._session_script, 0o777)
+        self.__open_output()
+
+    def __open_output(self):
+        """ Create the ring buffer of the output, docker keeps the output of the containers itself """
+        if self.backend != 'docker':
+            ring = self._session_dir + 'output.ring' if Session.output_mmap else None
+            self.output = RingBuffer(Session.output_size, ring)
+
+        # The tmux pane is piped into a fifo that we hold open for reading and writing so it never ends
+        if self.backend == 'tmux':
+            if not os.path.exists(self._session_dir + 'output.fifo'):
+                os.mkfifo(self._session_dir + 'output.fifo')
+
+            self.__fifo = os.open(self._session_dir + 'output.fifo', os.O_RDWR | os.O_NONBLOCK)
+            Session.pump().add(self.__fifo, (self.output,), partial(os.close, self.__fifo))
+
+    def state(self):
+        """ The record of the session in the journal """
+        return {
+            'id': self.id,
+            'backend': self.backend,
+            'pid': self.pid(),
+            'port': self._port,
+            'script': Journal.script_hash(self.__script),
+        }
+
+    def adopt(self, pid=None):
+        """ Take over the session a daemon that is gone left running, False when it is not running anymore """
+        _log.info('Adopt session: ' + repr(self))
+
+        if self.backend == 'docker':
+            return Session.Docker(self.id, 'None').is_running()
+
+        # The output pipe of a native session went with the old daemon, kill it if the pid is still its process
+        if self.backend == 'native':
+            try:
+                if pid is not None and pid > 0 and psutil.Process(pid).cwd() == self._session_dir.rstrip('/'):
+                    os.killpg(pid, signal.SIGKILL)
+            except (psutil.Error, ProcessLookupError, PermissionError):
+                pass
+
+            return False
+
+        self.__open_output()
+
+        try:
+            self.__pid = Session.Tmux(self.id).adopt(self.__fifo_path())
+        except RuntimeError:
+            return False
+
+        return True
 
     def remove(self):
-        """ Remove the session """
+        """ Remove the session, a docker container is stopped in the background and its future returned """
         _log.info('Remove session: ' + repr(self))
-        if self.__use_docker:
-            Session.Docker(self.id, 'None').remove()
+        clock = time()
+        future = None
+
+        if self.backend == 'docker':
+            future = Session.Docker(self.id, 'None').remove()
+        elif self.backend == 'native':
+            Session.Native(self.id).remove(self.__pid)
         else:
-            Session.Tmux(self.id).remove()
+            Session.Tmux(self.id).remove(self.__pid)
+
+        if self.__fifo is not None:
+            Session.pump().remove(self.__fifo)
+
+        if self.output is not None:
+            self.output.close()
+
+        remove(self._session_dir)
+        self.__cloud.ports().release(self._port)
+        _remove_seconds.since(clock, self.backend)
+
+        return future
+
+    @staticmethod
+    def remove_all(sessions, grace=None):
+        """ Remove the sessions, docker containers are stopped together in the background """
+        containers = []
+
+        for session in sessions:
+            if session.backend != 'docker':
+                session.remove()
+                continue
 
-        if self.__pid > 0:
+            _log.info('Remove session: ' + repr(session))
+            remove(session._session_dir)
+            session.__cloud.ports().release(session._port)
+            containers.append(Session.Docker(session.id, 'None').session)
+
+        return Session.Docker.remove_all(containers, grace) if len(containers) > 0 else None
+
+    def terminate(self):
+        """ Send SIGTERM to the process group of the session so it can exit on its own """
+        pid = self.pid()
+
+        if pid is not None and pid > 0:
             try:
-                subprocess.call("kill -9 " + str(self.__pid))
-            except FileNotFoundError:
+                os.killpg(pid, signal.SIGTERM)
+            except (ProcessLookupError, PermissionError):
                 # Process is not running
                 pass
 
-        remove(self._session_dir)
+    def is_running(self):
+        """ Is any process of the session process group still running, docker sessions have none """
+        pid = self.pid()
+
+        if pid is None or pid <= 0:
+            return False
+
+        try:
+            os.killpg(pid, 0)
+            return True
+        except (ProcessLookupError, PermissionError):
+            return False
+
+    def prewarm(self):
+        """ Get the session ready to start, the process or docker container waits to be resumed """
+        if self.backend == 'docker':
+            docker_image, options = self.__docker_options()
+            self.__cloud.images().ensure(docker_image)
+            Session.Docker(self.id, docker_image).prewarm(self._port, options)
+        elif self.backend == 'native':
+            self.__pid = Session.Native(self.id).prewarm(self._session_script, self._session_dir, self._session_log,
+                                                         self.output)
+        else:
+            self.__pid = Session.Tmux(self.id).prewarm(self._session_script, self._session_dir, self.__fifo_path())
+
+        self.__warm = True
+        _log.info('Prewarmed session: ' + str(self))
 
     def start(self):
         """ Start the session """
+        clock = time()
+
         with open(self._session_config, 'w') as file:
             pretty = JSONEncoder(indent=4, separators=[',', ': ']).encode({
                 'hostname': default_val(self.__cloud.settings['hostname'], socket.gethostname()),
                 'port': self._port,
-                'sessions': len(self.__cloud.sessions()),
+                'sessions': self.__cloud.session_count() + 1,
             })
             print(pretty, file=file)
 
-        if self.__use_docker:
-            # The script is just the docker image to use with options as keyword args
-            with open(self._session_script, 'r') as script:
-                docker_image = script.readline().rstrip()
-                options = JSONDecoder().decode(''.join(script.readlines()).rstrip().replace('\'', '"', 2048))
+        if self.backend == 'docker':
+            docker_image, options = self.__docker_options()
+
+            if self.__warm:
+                Session.Docker(self.id, docker_image).resume()
+            else:
+                pull = time()
+                self.__cloud.images().ensure(docker_image)
+
+                if self.trace is not None:
+                    self.trace.span('pull', pull, parent='launch', image=docker_image)
+
                 Session.Docker(self.id, docker_image).create(self._port, options)
+        elif self.backend == 'native':
+            if self.__warm:
+                Session.Native(self.id).resume()
+            else:
+                self.__pid = Session.Native(self.id).create(self._session_script, self._session_dir, self._session_log,
+                                                        self.output)
+        elif self.__warm:
+            Session.Tmux(self.id).resume()
         else:
-            self.__pid = Session.Tmux(self.id).create(self._session_script)
+            self.__pid = Session.Tmux(self.id).create(self._session_script, self._session_dir, self.__fifo_path())
 
+        _start_seconds.since(clock, self.backend)
         _log.info('Starting session: ' + str(self))
 
+    def __fifo_path(self):
+        """ The fifo the tmux pane is piped into """
+        return self._session_dir + 'output.fifo' if self.__fifo is not None else None
+
+    def tail(self, lines):
+        """ Get the last lines of the output """
+        if self.backend == 'docker':
+            return Session.Docker(self.id, 'None').logs(lines)
+
+        return self.output.tail(lines) if self.output is not None else []
+
+    def follow(self, cursor=None):
+        """ Get the lines written since the cursor and the cursor to use next, without a cursor no lines are sent """
+        if self.backend == 'docker':
+            now = time()
+            return [] if cursor is None else Session.Docker(self.id, 'None').logs(since=cursor, until=now), now
+
+        if self.output is None:
+            return [], cursor
+        elif cursor is None:
+            return [], self.output.offset()
+
+        return self.output.lines(cursor)
+
+    def __docker_options(self):
+        """ The script is just the docker image to use with options as keyword args """
+        with open(self._session_script, 'r') as script:
+            docker_image = script.readline().rstrip()
+            options = JSONDecoder().decode(''.join(script.readlines()).rstrip().replace('\'', '"', 2048))
+
+        return docker_image, options
+
+    def pid(self):
+        """ Get the pid of the process of the session, docker sessions have none """
+        if self.backend == 'docker':
+            return None
+
+        if self.__pid <= 0 and self.backend == 'tmux':
+            self.__pid = Session.Tmux(self.id).pane_pid()
+
+        return self.__pid
+
+    def restart(self):
+        """ Start the session again after it died """
+        _log.info('Restarting session: ' + repr(self))
+        self.__processes = {}
+        self.__docker_stats = None
+
+        if self.backend == 'docker':
+            Session.Docker(self.id, 'None').resume()
+        elif self.backend == 'native':
+            self.__pid = Session.Native(self.id).create(self._session_script, self._session_dir, self._session_log,
+                                                        self.output)
+        else:
+            self.__pid = Session.Tmux(self.id).create(self._session_script, self._session_dir, self.__fifo_path())
+
+        self.restarts += 1
+        self.alive = True
+
+    def usage(self):
+        """ Get the cpu percent and the memory bytes the session is using """
+        if self.backend == 'docker':
+            usage, self.__docker_stats = Session.Docker(self.id, 'None').usage(self.__docker_stats)
+            return usage
+
+        # Keep the process objects so the cpu percent covers the time since the last sample
+        if len(self.__processes) == 0:
+            pid = self.pid()
+            self.__processes[pid] = psutil.Process(pid)
+
+        root = next(iter(self.__processes.values()))
+        processes = {root.pid: root}
+
+        for child in root.children(recursive=True):
+            processes[child.pid] = self.__processes.get(child.pid, child)
+
+        cpu = 0.0
+        memory = 0
+
+        for process in processes.values():
+            try:
+                cpu += process.cpu_percent(interval=None)
+                memory += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+
+        self.__processes = processes
+        return cpu, memory
+
     def __repr__(self):
         """ Use the session id to represent this session """
         return self.id
@@ -116,38 +399,190 @@ class Session:
         return "id: {0}, pid: {1}, port: {2}".format(self.id, self.__pid, self._port)
 
     class Tmux:
-        """ The wrapper to handle TMUX """
+        """ The wrapper to handle TMUX, the commands are sent over one control mode client """
+        __control = None
+        __lock = Lock()
 
         def __init__(self, session, name='PyCloud'):
             self.session = check_not_none(session)
             self.name = name
 
         @staticmethod
-        def __cmd(command):
-            try:
-                args = ('tmux',) + tuple(command)
-                return subprocess.Popen(args)
-            except:
-                _log.info('Could not process tmux cmd')
-                raise
+        def control():
+            """ The tmux control mode client shared by every session """
+            with Session.Tmux.__lock:
+                if Session.Tmux.__control is None:
+                    Session.Tmux.__control = TmuxControl()
 
-        def create(self, cmd=None):
-            """ Create a new tmux session """
-            args = ('new', '-s', self.session, '-n', self.name)
+                return Session.Tmux.__control
+
+        def create(self, cmd=None, cwd=None, fifo=None):
+            """ Create a new tmux session and return the pid of its pane, the pane output is piped into the fifo """
+            # The cmd waits until the pane is piped so none of its output is lost
+            if cmd is not None and fifo is not None:
+                pid = self.prewarm(cmd, cwd, fifo)
+                self.resume()
+                return pid
+
+            return self.__new(cmd, cwd, fifo)
+
+        def __new(self, cmd=None, cwd=None, fifo=None):
+            """ Run new-session then pipe the pane into the fifo """
+            args = ('new-session', '-d', '-s', self.session, '-n', self.name, '-P', '-F', '#{window_id} #{pane_pid}')
+
+            if cwd is not None:
+                args += ('-c', cwd)
 
             if cmd is not None:
-                args += ('-d', cmd)
+                args += (cmd,)
+
+            output = Session.Tmux.control().command(*args, session=self.session)
+
+            if fifo is not None:
+                self.pipe(fifo)
+
+            return int(output[0].split()[1])
+
+        def pipe(self, fifo):
+            """ Pipe the pane output into the fifo, a pipe that is already open is closed first """
+            Session.Tmux.control().command('pipe-pane', '-O', '-t', self.session, 'exec cat > ' + shlex.quote(fifo))
+
+        def adopt(self, fifo=None):
+            """ Track the tmux session again and pipe its pane into the fifo, returns the pid of its pane """
+            output = Session.Tmux.control().command('list-panes', '-t', self.session, '-F', '#{window_id} #{pane_pid}',
+                                                    session=self.session)
+
+            if fifo is not None:
+                self.pipe(fifo)
+
+            return int(output[0].split()[1])
+
+        @staticmethod
+        def sessions():
+            """ Get the names of every tmux session """
+            return Session.Tmux.control().command('list-sessions', '-F', '#{session_name}')
+
+        def prewarm(self, cmd, cwd=None, fifo=None):
+            """ Create a tmux session that waits for resume before it runs the cmd """
+            return self.__new('read _ && exec ' + cmd, cwd, fifo)
 
-            return Session.Tmux.__cmd(args).pid
+        def resume(self):
+            """ Let the prewarmed tmux session run its cmd """
+            Session.Tmux.control().command('send-keys', '-t', self.session, 'Enter')
 
-        def remove(self):
-            """ Remove tmux session """
-            args = ('kill-session', '-t', self.session)
-            return Session.Tmux.__cmd(args).pid
+        def pane_pid(self):
+            """ Get the pid of the process running in the tmux pane """
+            output = Session.Tmux.control().command('display-message', '-p', '-t', self.session, '#{pane_pid}')
+            return int(output[0])
+
+        def remove(self, pid=None):
+            """ Kill the process group of the pane then the tmux session """
+            if pid is not None and pid > 0:
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    # Process is not running
+                    pass
+
+            try:
+                Session.Tmux.control().command('kill-session', '-t', self.session)
+                return True
+            except RuntimeError:
+                return False
+
+    class Native:
+        """ Run the script as a plain process in its own process group, its output goes to rotating logs """
+        log_size = 10 * 1024 * 1024
+        log_count = 3
+        cgroup = None
+        cpu = None
+        memory = None
+        __processes = None
+        __lock = Lock()
+
+        def __init__(self, session):
+            self.session = check_not_none(session)
+
+        @staticmethod
+        def configure(log_size=None, log_count=None, cgroup=None, cpu=None, memory=None):
+            """ Set the size and count of the logs and the cgroup v2 directory and limits of the sessions """
+            Session.Native.log_size = default_val(log_size, Session.Native.log_size)
+            Session.Native.log_count = default_val(log_count, Session.Native.log_count)
+            Session.Native.cgroup = default_val(cgroup, Session.Native.cgroup)
+            Session.Native.cpu = default_val(cpu, Session.Native.cpu)
+            Session.Native.memory = default_val(memory, Session.Native.memory)
+
+        @staticmethod
+        def processes():
+            """ The processes of every native session """
+            with Session.Native.__lock:
+                if Session.Native.__processes is None:
+                    Session.Native.__processes = NativeProcesses(Session.pump())
+
+                return Session.Native.__processes
+
+        def __cgroup(self):
+            """ Make the cgroup of the session with the limits, None when cgroups are not used """
+            if Session.Native.cgroup is None:
+                return None
+
+            path = os.path.join(Session.Native.cgroup, self.session)
+            os.makedirs(path, exist_ok=True)
+
+            if Session.Native.cpu is not None:
+                with open(os.path.join(path, 'cpu.max'), 'w') as file:
+                    file.write('{0} 100000'.format(int(float(Session.Native.cpu) * 100000)))
+
+            if Session.Native.memory is not None:
+                with open(os.path.join(path, 'memory.max'), 'w') as file:
+                    file.write(str(int(Session.Native.memory)))
+
+            return path
+
+        def create(self, cmd, cwd, log, output=None, wait=False):
+            """ Start the cmd and return its pid, the output goes to the log and output ring buffer """
+            cgroup = self.__cgroup()
+            shell = ''
+
+            # The shell joins the cgroup before the cmd can fork so every child is limited
+            if cgroup is not None:
+                shell += 'echo $$ > "$2/cgroup.procs" && '
+
+            if wait:
+                shell += 'read _ && '
+
+            # Like tmux the cmd runs through sh so a script without a shebang still runs
+            args = ('/bin/sh', '-c', shell + 'exec "$1"', 'pycloud', cmd, str(cgroup))
+            log = RotatingLog(log, Session.Native.log_size, Session.Native.log_count)
+            sinks = (log,) if output is None else (log, output)
+            return Session.Native.processes().spawn(self.session, args, cwd, sinks, wait)
+
+        def prewarm(self, cmd, cwd, log, output=None):
+            """ Start a process that waits for resume before it runs the cmd """
+            return self.create(cmd, cwd, log, output, True)
+
+        def resume(self):
+            """ Let the prewarmed process run its cmd """
+            Session.Native.processes().resume(self.session)
+
+        def remove(self, pid=None):
+            """ Kill the process group and remove the cgroup """
+            Session.Native.processes().remove(self.session, pid)
+
+            if Session.Native.cgroup is not None:
+                try:
+                    os.rmdir(os.path.join(Session.Native.cgroup, self.session))
+                except OSError:
+                    pass
 
     class Docker:
         """ Wrapper to create docker containers """
-        client = docker.from_env()
+        pool_size = 10
+        grace = 10
+        __client = None
+        __events = None
+        __lock = Lock()
+        __teardown = ThreadPoolExecutor(max_workers=2)
 
         def __init__(self, session, name):
             """
@@ -158,20 +593,464 @@ class Session:
             self.session = 'pycloud_' + check_not_none(session)
             self.name = check_not_none(name)
 
-        def create(self, port, json):
-            """ Create the docker container """
+        @staticmethod
+        def configure(pool_size=None, grace=None):
+            """ Set the connection pool size of the client and the grace period to stop containers """
+            Session.Docker.pool_size = default_val(pool_size, Session.Docker.pool_size)
+            Session.Docker.grace = default_val(grace, Session.Docker.grace)
+
+        @staticmethod
+        def client():
+            """ The docker client shared by every thread, requests are spread over its connection pool """
+            with Session.Docker.__lock:
+                if Session.Docker.__client is None:
+                    Session.Docker.__client = docker.from_env(max_pool_size=Session.Docker.pool_size)
+
+                return Session.Docker.__client
+
+        @staticmethod
+        def events():
+            """ The watcher of the docker events of the pycloud containers """
+            client = Session.Docker.client()
+
+            with Session.Docker.__lock:
+                if Session.Docker.__events is None:
+                    Session.Docker.__events = DockerEvents(client)
+
+                return Session.Docker.__events
+
+        def __options(self, port, json):
+            """ Map the port and label the container so its events can be watched """
             ports = {str(json['port']) + '/tcp': port}
             del json['port']
-            self.client.containers.run(self.name, detach=True, name=self.session, ports=ports, **json)
+            labels = json.pop('labels', None)
+            labels = dict(labels) if isinstance(labels, dict) else {label: '' for label in default_val(labels, ())}
+            labels['pycloud'] = self.session
+            return dict(json, name=self.session, ports=ports, labels=labels)
+
+        def create(self, port, json):
+            """ Create the docker container """
+            Session.Docker.events()
+            self.client().containers.run(self.name, detach=True, **self.__options(port, json))
+            return 0
+
+        def prewarm(self, port, json):
+            """ Create the docker container without starting it """
+            Session.Docker.events()
+            self.client().containers.create(self.name, **self.__options(port, json))
             return 0
 
-        def remove(self):
-            """ remove the docker container """
+        def resume(self):
+            """ Start the prewarmed docker container """
+            self.client().api.start(self.session)
+            return 0
+
+        def usage(self, last=None):
+            """ Get the cpu percent and memory bytes of the container and the stats to use next time """
+            stats = self.client().api.stats(self.session, stream=False, one_shot=True)
+            cpu = 0.0
+
+            # One shot stats have no previous cpu so use the stats from the last sample
+            if last is not None:
+                container_delta = stats['cpu_stats']['cpu_usage']['total_usage'] - \
+                    last['cpu_stats']['cpu_usage']['total_usage']
+                system_delta = stats['cpu_stats'].get('system_cpu_usage', 0) - \
+                    last['cpu_stats'].get('system_cpu_usage', 0)
+                cpus = stats['cpu_stats'].get('online_cpus', 1)
+
+                if system_delta > 0:
+                    cpu = container_delta * 100.0 * cpus / system_delta
+
+            return (cpu, stats['memory_stats'].get('usage', 0)), stats
+
+        def is_running(self):
+            """ Is the container running """
             try:
-                container = self.client.containers.get(self.session)
-                container.stop()
-                container.remove()
+                return self.client().api.inspect_container(self.session)['State']['Running']
             except docker.errors.NotFound:
-                _log.warning('Docker Container Not Found: {}'.format(self.session))
+                return False
 
-            return 0
+        @staticmethod
+        def containers():
+            """ Get the names of every pycloud container """
+            containers = Session.Docker.client().api.containers(all=True, filters={'label': 'pycloud'})
+            return [name.lstrip('/') for container in containers for name in container['Names']]
+
+        def logs(self, tail=None, since=None, until=None):
+            """ Get the lines of output of the container, the last tail lines or the ones between since and until """
+            tail = 'all' if tail is None else tail
+            output = self.client().api.logs(self.session, tail=tail, since=since, until=until)
+            return output.decode('utf-8', 'replace').splitlines()
+
+        def remove(self, grace=None):
+            """ Stop and remove the docker container in the background, returns the future """
+            return Session.Docker.remove_all((self.session,), grace)
+
+        @staticmethod
+        def remove_all(containers, grace=None):
+            """ Stop and remove the docker containers in the background, returns the future """
+            return Session.Docker.__teardown.submit(Session.Docker.__stop, tuple(containers), grace)
+
+        @staticmethod
+        def __stop(containers, grace):
+            """ Send SIGTERM to every container, SIGKILL the ones that did not die in the grace period """
+            api = Session.Docker.client().api
+            events = Session.Docker.events()
+            grace = default_val(grace, Session.Docker.grace)
+            deadline = time() + grace
+            dying = {}
+
+            for container in containers:
+                dead = events.wait_for(container, 'die')
+
+                try:
+                    api.kill(container, 'SIGTERM')
+                    dying[container] = dead
+                except docker.errors.NotFound:
+                    events.forget(container, 'die')
+                    _log.warning('Docker Container Not Found: {}'.format(container))
+                except docker.errors.APIError:
+                    # The container is not running so it can be removed right away
+                    events.forget(container, 'die')
+                    dying[container] = None
+
+            for container, dead in dying.items():
+                if dead is not None and not dead.wait(max(deadline - time(), 0)):
+                    events.forget(container, 'die')
+
+                    try:
+                        api.kill(container, 'SIGKILL')
+                    except docker.errors.APIError:
+                        pass
+
+                try:
+                    api.remove_container(container, force=True)
+                except docker.errors.NotFound:
+                    pass
+                except docker.errors.APIError as error:
+                    _log.error('Could not remove docker container {0}: {1}'.format(container, error))
+
+            return len(dying)
+
+
+class DockerEvents:
+    """ Follow the events of the pycloud containers in one thread instead of blocking on api calls """
+
+    def __init__(self, client):
+        """ Start watching the events of the client """
+        self.__client = check_not_none(client)
+        self.__lock = Lock()
+        self.__waiters = {}
+        self.__listeners = []
+        thread = Thread(target=self.__watch, name='PyCloud Docker Events Thread', daemon=True)
+        thread.start()
+
+    def listen(self, callback):
+        """ Call the callback with the session container name and action of every event """
+        self.__listeners.append(callback)
+
+    def wait_for(self, container, action):
+        """ Get an event that is set when the container has the action """
+        with self.__lock:
+            return self.__waiters.setdefault((container, action), Event())
+
+    def forget(self, container, action):
+        """ Stop waiting for the action of the container """
+        with self.__lock:
+            self.__waiters.pop((container, action), None)
+
+    def __watch(self):
+        """ Read the events stream for ever """
+        filters = {'type': 'container', 'label': 'pycloud'}
+
+        while True:
+            try:
+                for event in self.__client.events(decode=True, filters=filters):
+                    container = event.get('Actor', {}).get('Attributes', {}).get('name')
+                    action = event.get('Action', event.get('status'))
+
+                    with self.__lock:
+                        waiter = self.__waiters.pop((container, action), None)
+
+                    if waiter is not None:
+                        waiter.set()
+
+                    for callback in self.__listeners:
+                        try:
+                            callback(container, action)
+                        except Exception as error:
+                            _log.error('Exception in docker event listener: ' + str(error))
+            except Exception as error:
+                _log.error('Docker events error, trying again in 5 secs: ' + str(error))
+                sleep(5)
+
+
+class TmuxControl:
+    """ Send the tmux commands over one control mode client and follow its notifications """
+    session = 'pycloud'
+
+    def __init__(self, timeout=10):
+        """ The client is started when the first command is sent """
+        self.__timeout = timeout
+        self.__lock = Lock()
+        self.__process = None
+        self.__pending = deque()
+        self.__windows = {}
+        self.__listeners = []
+        self.__notifier = ThreadPoolExecutor(max_workers=1)
+
+    def listen(self, callback):
+        """ Call the callback with the session id of every tmux session that exits """
+        self.__listeners.append(callback)
+
+    @staticmethod
+    def quote(arg):
+        """ Quote the arg for the tmux command parser """
+        return '"' + str(arg).replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$') + '"'
+
+    def command(self, *args, session=None):
+        """ Send the command and wait for its output lines, the window it makes is tracked for the session """
+        future = Future()
+        line = ' '.join(TmuxControl.quote(arg) for arg in args) + '\n'
+
+        with self.__lock:
+            process = self.__connect()
+            self.__pending.append((future, session))
+
+            try:
+                process.stdin.write(line.encode('utf-8'))
+                process.stdin.flush()
+            except OSError:
+                self.__pending.pop()
+                raise
+
+        return future.result(self.__timeout)
+
+    def __connect(self):
+        """ Start the control mode client if it is not running, must hold the lock """
+        if self.__process is not None:
+            return self.__process
+
+        # The control client needs a session to attach to, it runs cat so it never has output
+        args = ('tmux', '-C', 'new-session', '-A', '-s', TmuxControl.session, 'cat')
+        self.__process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          stderr=subprocess.DEVNULL)
+        thread = Thread(target=self.__read, args=(self.__process,), name='PyCloud Tmux Control Thread', daemon=True)
+        thread.start()
+
+        return self.__process
+
+    def __read(self, process):
+        """ Match the output blocks to the commands in the order they were sent and watch for closed windows """
+        output = None
+        number = None
+        own = False
+
+        for raw in process.stdout:
+            line = raw.decode('utf-8', 'replace').rstrip('\n')
+
+            if output is not None:
+                parts = line.split()
+
+                if len(parts) == 4 and parts[0] in ('%end', '%error') and parts[2] == number:
+                    if own:
+                        self.__complete(parts[0] == '%end', output)
+
+                    output = None
+                else:
+                    output.append(line)
+            elif line.startswith('%begin '):
+                parts = line.split()
+                number = parts[2]
+                own = int(parts[3]) & 1 == 1
+                output = []
+            elif line.startswith(('%window-close ', '%unlinked-window-close ')):
+                self.__closed(line.split()[1])
+            elif line.startswith('%exit'):
+                break
+
+        process.wait()
+
+        with self.__lock:
+            if self.__process is process:
+                self.__process = None
+
+            pending = list(self.__pending)
+            self.__pending.clear()
+
+        for future, _ in pending:
+            future.set_exception(RuntimeError('The tmux control client exited'))
+
+        # The sessions may have died with the tmux server so check the windows we know of
+        if len(self.__windows) > 0:
+            self.__notifier.submit(self.__resync)
+
+    def __complete(self, success, output):
+        """ Finish the oldest command, the window is tracked before any notification for it is read """
+        future, session = self.__pending.popleft()
+
+        if not success:
+            future.set_exception(RuntimeError('tmux: ' + ' '.join(output)))
+            return
+
+        if session is not None and len(output) > 0 and output[0].startswith('@'):
+            self.__windows[output[0].split()[0]] = session
+
+        future.set_result(output)
+
+    def __closed(self, window):
+        """ The window of a session closed, the listeners are called off the reader thread """
+        session = self.__windows.pop(window, None)
+
+        if session is not None:
+            self.__notifier.submit(self.__notify, session)
+
+    def __notify(self, session):
+        """ Let the listeners know the session exited """
+        for callback in self.__listeners:
+            try:
+                callback(session)
+            except Exception as error:
+                _log.error('Exception in tmux session listener: ' + str(error))
+
+    def __resync(self):
+        """ Close the windows that are no longer in the tmux server """
+        try:
+            running = set(self.command('list-windows', '-a', '-F', '#{window_id}'))
+        except (OSError, RuntimeError) as error:
+            _log.error('Could not list the tmux windows: ' + str(error))
+            running = set()
+
+        for window in list(self.__windows):
+            if window not in running:
+                self.__closed(window)
+
+
+class NativeProcesses:
+    """ Start the native sessions and follow their exits with one epoll in one thread, the pump copies their output """
+
+    def __init__(self, pump):
+        """ The thread is started with the first process """
+        self.__pump = check_not_none(pump)
+        self.__lock = Lock()
+        self.__epoll = select.epoll()
+        self.__processes = {}
+        self.__exits = {}
+        self.__listeners = []
+        self.__notifier = ThreadPoolExecutor(max_workers=1)
+        self.__thread = None
+
+    def listen(self, callback):
+        """ Call the callback with the session id of every native session that exits """
+        self.__listeners.append(callback)
+
+    def spawn(self, session, args, cwd, sinks, wait=False):
+        """ Start the process in a new process group and return its pid, stdin is kept open when it must wait """
+        process = subprocess.Popen(args, cwd=cwd, stdin=subprocess.PIPE if wait else subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        self.__pump.add(process.stdout.fileno(), sinks, partial(NativeProcesses.__close, process, sinks), process)
+
+        with self.__lock:
+            self.__processes[session] = process
+
+            # Without pidfds the exits are found by polling the processes
+            if hasattr(os, 'pidfd_open'):
+                exit_fd = os.pidfd_open(process.pid)
+                self.__exits[exit_fd] = (session, process)
+                self.__epoll.register(exit_fd, select.EPOLLIN)
+
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name='PyCloud Native Thread', daemon=True)
+                self.__thread.start()
+
+        return process.pid
+
+    @staticmethod
+    def __close(process, sinks):
+        """ The output of the process ended """
+        process.stdout.close()
+        sinks[0].close()
+
+    def resume(self, session):
+        """ Let the waiting process run """
+        with self.__lock:
+            process = self.__processes[session]
+
+        process.stdin.write(b'\n')
+        process.stdin.close()
+
+    def remove(self, session, pid=None):
+        """ Kill the process group of the session, even when its leader already exited the children are killed """
+        with self.__lock:
+            process = self.__processes.pop(session, None)
+
+        if process is not None:
+            pid = process.pid
+
+        if pid is not None and pid > 0:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                # Process is not running
+                pass
+
+        if process is None:
+            return
+
+        if process.stdin is not None:
+            process.stdin.close()
+
+        # Children that left the process group may still hold the pipe
+        try:
+            self.__pump.remove(process.stdout.fileno(), process)
+        except ValueError:
+            # The output already ended
+            pass
+
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            _log.error('Native session {0} did not die after SIGKILL'.format(session))
+
+    def __run(self):
+        """ Pass on the exits """
+        polling = not hasattr(os, 'pidfd_open')
+
+        while True:
+            for fd, _ in self.__epoll.poll(1 if polling else -1):
+                with self.__lock:
+                    ended = self.__exits.pop(fd, None)
+
+                    if ended is not None:
+                        self.__epoll.unregister(fd)
+
+                if ended is not None:
+                    os.close(fd)
+                    ended[1].wait()
+                    self.__exited(*ended)
+
+            if polling:
+                with self.__lock:
+                    processes = list(self.__processes.items())
+
+                for session, process in processes:
+                    if process.poll() is not None:
+                        self.__exited(session, process)
+
+    def __exited(self, session, process):
+        """ Let the listeners know the session exited unless it was removed """
+        with self.__lock:
+            if self.__processes.get(session) is not process:
+                return
+
+            self.__processes.pop(session)
+
+        self.__notifier.submit(self.__notify, session)
+
+    def __notify(self, session):
+        """ Call the listeners off the epoll thread """
+        for callback in self.__listeners:
+            try:
+                callback(session)
+            except Exception as error:
+                _log.error('Exception in native session listener: ' + str(error))
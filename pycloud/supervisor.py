@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" Watch the sessions for exits and reap or restart the dead ones """
+
+import heapq
+import logging
+from threading import Lock, Thread, Event
+from time import time
+from .session import Session
+from .utils import check_not_none, default_val
+
+
+_log = logging.getLogger('pycloud')
+
+
+class Supervisor:
+    """ Follow the exits of the sessions from the tmux control client, the native processes or the docker events """
+
+    def __init__(self, cloud, restart=False, backoff=None, max_backoff=None):
+        """ Create the supervisor, dead sessions are restarted with a doubling backoff when restart is on """
+        self.__cloud = check_not_none(cloud)
+        self.__restart = bool(restart)
+        self.__backoff = default_val(backoff, 1)
+        self.__max_backoff = default_val(max_backoff, 60)
+        self.__lock = Lock()
+        self.__listeners = []
+        self.__restarts = []
+        self.__restarting = set()
+        self.__started = {}
+        self.__wake = Event()
+        self.__docker = False
+        self.__thread = None
+
+    def listen(self, callback):
+        """ Call the callback with the session id of every session that is reaped """
+        self.__listeners.append(callback)
+
+    def restarting(self):
+        """ The number of dead sessions waiting to restart """
+        return len(self.__restarting)
+
+    def watch(self, session):
+        """ Start watching the session for its exit """
+        self.__start(session.backend == 'docker')
+        self.__started[session.id] = time()
+
+    def __start(self, docker=False):
+        """ Start the thread that restarts the dead sessions, docker events are followed from the first container """
+        with self.__lock:
+            if docker and not self.__docker:
+                Session.Docker.events().listen(self.__docker_event)
+                self.__docker = True
+
+            if self.__thread is not None:
+                return
+
+            self.__thread = Thread(target=self.__run, name='PyCloud Supervisor Thread', daemon=True)
+            self.__thread.start()
+
+    def __docker_event(self, container, action):
+        """ Docker containers are watched with the events stream """
+        if action == 'die' and container is not None and container.startswith('pycloud_'):
+            self.exited(container[len('pycloud_'):])
+
+    def __run(self):
+        """ Wait for the restarts that are due """
+        while True:
+            with self.__lock:
+                timeout = max(self.__restarts[0][0] - time(), 0) if len(self.__restarts) > 0 else None
+
+            self.__wake.wait(timeout)
+            self.__wake.clear()
+            self.__restart_due()
+
+    def exited(self, session_id):
+        """ The session died, restart it or reap it """
+        session = self.__cloud.get_session(session_id)
+
+        # Sessions we removed ourselves are already gone
+        if session is None or not session.alive:
+            return
+
+        session.alive = False
+        _log.info('Session exited: ' + session_id)
+
+        if not self.__restart:
+            self.reap(session_id)
+            return
+
+        # Start the backoff over when the session ran longer than the max backoff
+        if time() - self.__started.get(session_id, 0) > self.__max_backoff:
+            session.restarts = 0
+
+        delay = min(self.__backoff * 2 ** session.restarts, self.__max_backoff)
+
+        with self.__lock:
+            self.__restarting.add(session_id)
+            heapq.heappush(self.__restarts, (time() + delay, session_id))
+
+        self.__wake.set()
+
+    def __restart_due(self):
+        """ Restart the sessions whose backoff is over """
+        while True:
+            with self.__lock:
+                if len(self.__restarts) == 0 or self.__restarts[0][0] > time():
+                    return
+
+                _, session_id = heapq.heappop(self.__restarts)
+                self.__restarting.discard(session_id)
+
+            session = self.__cloud.get_session(session_id)
+
+            if session is None:
+                continue
+
+            try:
+                session.restart()
+                self.__cloud.journal().add(session)
+                self.watch(session)
+            except Exception as error:
+                _log.error('Could not restart session {0}: {1}'.format(session_id, error))
+                self.reap(session_id)
+
+    def reap(self, session_id):
+        """ Remove the dead session and let the listeners know """
+        self.__started.pop(session_id, None)
+
+        try:
+            self.__cloud.remove_session(session_id)
+        except Exception as error:
+            _log.error('Could not reap session {0}: {1}'.format(session_id, error))
+            return
+
+        for callback in self.__listeners:
+            try:
+                callback(session_id)
+            except Exception as error:
+                _log.error('Exception in supervisor listener: ' + str(error))
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+# Copyright 2016 Year4000.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Trace the stages of a request so the time of a slow create can be found """
+
+import os
+import logging
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from json import JSONEncoder
+from random import random
+from time import time
+from .utils import default_val
+
+
+_log = logging.getLogger('pycloud')
+
+
+class Tracer:
+    """ Start the traces of the requests, the sampled and slow ones are logged and exported """
+
+    def __init__(self, sample=None, slow=None, export=None):
+        """ Sample the fraction of the traces, traces over slow secs are always kept, export is a json lines file """
+        self.sample = float(default_val(sample, 0))
+        self.slow = slow
+        self.export = export
+        self.__writer = ThreadPoolExecutor(max_workers=1) if export is not None else None
+
+    def start(self, request_id, name):
+        """ Start the trace of the request """
+        return Trace(self, request_id, name, self.sample > 0 and random() < self.sample)
+
+    def finish(self, trace):
+        """ Log and export the trace when it is sampled or slow """
+        if not trace.sampled and (self.slow is None or trace.duration() < self.slow):
+            return
+
+        _log.info('Trace {0} {1} in {2:.3f}s: {3}'.format(trace.id, trace.name, trace.duration(), ', '.join(
+            '{0}={1:.3f}s'.format(stage, duration) for stage, duration in trace.timings().items()
+        )))
+
+        if self.__writer is not None:
+            self.__writer.submit(self.__export, trace)
+
+    def __export(self, trace):
+        """ Append the trace to the export file as an OTLP json request """
+        try:
+            with open(self.export, 'a') as file:
+                print(JSONEncoder().encode(trace.otlp()), file=file)
+        except OSError as error:
+            _log.error('Could not export the trace: ' + str(error))
+
+
+class Trace:
+    """ The spans of one request, each stage starts where the one before it ended """
+
+    def __init__(self, tracer, request_id, name, sampled=False):
+        self.id = request_id
+        self.name = name
+        self.sampled = sampled
+        self.start = time()
+        self.end = None
+        self.spans = []
+        self.__tracer = tracer
+        self.__clock = self.start
+
+    def stage(self, name, **attributes):
+        """ End the stage that started when the last one ended """
+        now = time()
+        self.spans.append((name, self.__clock, now, None, attributes))
+        self.__clock = now
+        return now
+
+    def span(self, name, start, end=None, parent=None, **attributes):
+        """ Add a span that is inside a stage or did not start where the last one ended """
+        self.spans.append((name, start, default_val(end, time()), parent, attributes))
+
+    def stages(self, timings, start):
+        """ Add the stages that were timed back to back from the start """
+        for name, duration in timings.items():
+            self.spans.append((name, start, start + duration, None, {}))
+            start += duration
+
+        self.__clock = start
+
+    def duration(self):
+        """ The secs from the start to the end or the last stage """
+        return default_val(self.end, self.__clock) - self.start
+
+    def timings(self):
+        """ The secs of every span by name in the order they started """
+        timings = OrderedDict()
+
+        for name, start, end, _, _ in sorted(self.spans, key=lambda span: span[1]):
+            timings[name] = timings.get(name, 0) + end - start
+
+        return timings
+
+    def finish(self):
+        """ End the trace and let the tracer keep it """
+        self.end = time()
+        self.__tracer.finish(self)
+
+    def otlp(self):
+        """ The trace as an OpenTelemetry OTLP json request, the trace id is the hash of the request id """
+        trace_id = hashlib.md5(str(self.id).encode('utf-8')).hexdigest()
+        root_id = os.urandom(8).hex()
+        span_ids = {span[0]: os.urandom(8).hex() for span in self.spans}
+        start = min([self.start] + [span[1] for span in self.spans])
+        spans = [Trace.__span(trace_id, root_id, None, self.name, start, self.end, {'request.id': self.id})]
+
+        # Spans inside a stage are added before the stage ends so the ids are known first
+        for name, start, end, parent, attributes in self.spans:
+            parent_id = span_ids.get(parent, root_id)
+            spans.append(Trace.__span(trace_id, span_ids[name], parent_id, name, start, end, attributes))
+
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'pycloud'}}]},
+            'scopeSpans': [{'scope': {'name': 'pycloud'}, 'spans': spans}],
+        }]}
+
+    @staticmethod
+    def __span(trace_id, span_id, parent_id, name, start, end, attributes):
+        span = {
+            'traceId': trace_id,
+            'spanId': span_id,
+            'name': name,
+            'kind': 1,
+            'startTimeUnixNano': str(int(start * 1e9)),
+            'endTimeUnixNano': str(int(default_val(end, time()) * 1e9)),
+            'attributes': [{'key': key, 'value': {'stringValue': str(value)}} for key, value in attributes.items()],
+        }
+
+        if parent_id is not None:
+            span['parentSpanId'] = parent_id
+
+        return span
@@ -22,7 +22,8 @@ import subprocess
 import shutil
 import time
 import random
-from .constants import SESSION_DIR, DATA_DIR, LOG_DIR, CONFIG_DIR
+from hashlib import md5
+from .constants import SESSION_DIR, DATA_DIR, LOG_DIR, CONFIG_DIR, DEFAULT_GROUP
 
 
 FNULL = open(os.devnull, 'w')
@@ -76,6 +77,27 @@ def generate_id():
     return hex(random_number + process_id + system_time)[2:]
 
 
+def stable_hash(*parts):
+    """ A hash of the parts that is the same on every cloud """
+    return int(md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest(), 16)
+
+
+def sessions_hash(sessions, start=0):
+    """ An order independent hash of the session ids that can be updated one id at a time """
+    for session in sessions:
+        start ^= stable_hash(session) & 0xFFFFFFFFFFFFFFFF
+
+    return start
+
+
+def grouped(name, group=None):
+    """ Scope the channel or key to the group, the default group keeps the names it always had """
+    if group is None or group == DEFAULT_GROUP:
+        return name
+
+    return name.replace('year4000.pycloud.', 'year4000.pycloud.' + group + '.', 1)
+
+
 def check_not_none(var, message='Var is None'):
     """ Check that the var is not none """
     if var is None:
@@ -128,3 +150,27 @@ def required_paths():
         finally:
             os.chown(folder, 4000, 4000)
             os.chmod(folder, 0o775)
+
+
+class Backoff:
+    """ Wait longer after each failure, doubling up to the cap with jitter so clouds do not retry in step """
+
+    def __init__(self, base=None, cap=None):
+        """ The first delay is about base secs and no delay is more than cap secs """
+        self.base = default_val(base, 0.5)
+        self.cap = default_val(cap, 30)
+        self.attempts = 0
+
+    def next(self):
+        """ The secs to wait before the next try """
+        delay = min(self.cap, self.base * 2 ** self.attempts)
+
+        # Stop counting once the cap is reached so the power never overflows
+        if delay < self.cap:
+            self.attempts += 1
+
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        """ Start over after a success """
+        self.attempts = 0
@@ -52,5 +52,6 @@ setup(
     author='Year4000',
     url='https://github.com/Year4000/PyCloud',
     install_requires=['redis', 'PyYAML', 'psutil', 'docker'],
+    extras_require={'msgpack': ['msgpack']},
     packages=find_packages(),
 )